@@ -61,7 +61,8 @@ $(document).ready(function () {
 
           var messages = data.messages;
 
-          for (var message of messages) {
+          // const, so that the delayed card below renders this message and not the last one.
+          for (const message of messages) {
             console.log(message)
             if (message.type === 'unstructured') {
               console.log("here");
@@ -72,11 +73,15 @@ $(document).ready(function () {
               insertResponseMessage(message.structured.text);
 
               setTimeout(function () {
-                html = '<img src="' + message.structured.payload.imageUrl + '" witdth="200" height="240" class="thumbnail" /><b>' +
-                  message.structured.payload.name + '<br>$' +
-                  message.structured.payload.price +
-                  '</b><br><a href="#" onclick="' + message.structured.payload.clickAction + '()">' +
-                  message.structured.payload.buttonLabel + '</a>';
+                var payload = message.structured.payload;
+                var link = '';
+                if (payload.url) {
+                  link = '<br><a href="' + payload.url + '" target="_blank" rel="noopener">' + payload.buttonLabel + '</a>';
+                } else if (payload.clickAction) {
+                  link = '<br><a href="#" onclick="' + payload.clickAction + '()">' + payload.buttonLabel + '</a>';
+                }
+                html = (payload.imageUrl ? '<img src="' + payload.imageUrl + '" width="200" height="240" class="thumbnail" />' : '') +
+                  '<b>' + payload.name + (payload.price ? '<br>' + payload.price : '') + '</b>' + link;
                 insertResponseMessage(html);
               }, 1100);
             } else {
@@ -1,8 +1,28 @@
 import json
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
-import boto3
 import json
-from boto3.dynamodb.conditions import Key
+from awsClients import getClient, getResource
+
+# Sessions known to have no saved search, kept across warm invocations so their
+# messages skip the DynamoDB lookup. session id -> expiry (monotonic seconds).
+# Only this execution environment sees the cache, another one may consume or LF2 may
+# save the record meanwhile, so it is kept for a few seconds, enough for a burst of messages.
+NO_RECORD_TTL_SECONDS = int(os.environ.get('NO_RECORD_TTL_SECONDS', 5))
+NO_RECORD_MAX_ENTRIES = int(os.environ.get('NO_RECORD_MAX_ENTRIES', 10000))
+sessionsWithoutRecord = {}
+# Sessions fulfilled recently, LF2 saves their search some time after fulfillment (the SQS
+# message, the search and the email go first), so they are never cached as without a record
+# until their search was found or this many seconds passed. session id -> expiry (monotonic seconds).
+FULFILLED_PENDING_SECONDS = int(os.environ.get('FULFILLED_PENDING_SECONDS', 900))
+fulfilledSessions = {}
+
+# Utterances of different sessions are sent to Lex concurrently on this many threads.
+LEX_MAX_WORKERS = int(os.environ.get('LEX_MAX_WORKERS', 4))
+lexPool = ThreadPoolExecutor(max_workers=LEX_MAX_WORKERS)
 
 def createSlot(name,value):
     return {
@@ -56,44 +76,136 @@ def createResponse(lexClient,record):
         }]
     }
 
+def consumeSavedSearch(table, SID):
+    """Atomically reads and removes the search saved for a session, in one delete_item.
+
+    Returns the saved record or None. Sessions found without a record are remembered
+    for NO_RECORD_TTL_SECONDS so their next messages skip DynamoDB entirely, unless
+    they were fulfilled recently and LF2 may still save their search.
+    """
+    now = time.monotonic()
+    expiry = sessionsWithoutRecord.get(SID)
+    if expiry is not None:
+        if expiry > now:
+            return None
+        del sessionsWithoutRecord[SID]
+
+    response = table.delete_item(
+        Key={
+            'sessionid': SID
+        },
+        ReturnValues='ALL_OLD'
+    )
+    record = response.get('Attributes')
+    if record is not None:
+        fulfilledSessions.pop(SID, None)
+    elif fulfilledSessions.get(SID, 0) <= now:
+        # Not fulfilled lately, or LF2 had all the time it needs.
+        fulfilledSessions.pop(SID, None)
+        if len(sessionsWithoutRecord) >= NO_RECORD_MAX_ENTRIES:
+            sessionsWithoutRecord.clear()
+        sessionsWithoutRecord[SID] = now + NO_RECORD_TTL_SECONDS
+    return record
+
+def forgetSession(SID):
+    # LF2 saves a search for the session once its request is fulfilled, the lookups
+    # go to DynamoDB until it is found.
+    sessionsWithoutRecord.pop(SID, None)
+    if len(fulfilledSessions) >= NO_RECORD_MAX_ENTRIES:
+        fulfilledSessions.clear()
+    fulfilledSessions[SID] = time.monotonic() + FULFILLED_PENDING_SECONDS
+
+def recommendationCards(restaurants):
+    # Product cards, as rendered by frontend/assets/js/chat.js.
+    cards = []
+    for rank, restaurant in enumerate(restaurants, 1):
+        details = [f"{restaurant.get('rating')} stars"]
+        if restaurant.get('distance_km') is not None:
+            details.append(f"{restaurant['distance_km']} km away")
+        cards.append({
+            "type": "structured",
+            "structured": {
+                "type": "product",
+                "text": f"{rank}. {restaurant.get('name')}, {restaurant.get('address')} ({', '.join(details)})",
+                "payload": {
+                    "name": restaurant.get('name'),
+                    "imageUrl": restaurant.get('image_url'),
+                    "price": "$" * (restaurant.get('price_level') or 0),
+                    "url": restaurant.get('yelp_url'),
+                    "buttonLabel": "View on Yelp",
+                },
+            },
+        })
+    return cards
+
+def toChatMessages(message):
+    """Turns a Lex message into chat messages. Recommendations sent by LF1 as a custom payload become cards."""
+    if message.get("contentType") == "CustomPayload":
+        try:
+            payload = json.loads(message["content"])
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and payload.get("type") == "recommendations":
+            return recommendationCards(payload.get("restaurants") or [])
+    return [{"type": "unstructured", "unstructured": {"text": message["content"]}}]
+
+def recognizeText(lexClient, SID, text):
+    response = lexClient.recognize_text(
+        botId = "V4X2CJY560",
+        botAliasId = "TSTALIASID",
+        localeId = "en_US",
+        sessionId = SID,
+        text = text,
+    )
+    print(json.dumps(response))
+    if response.get("sessionState", {}).get("intent", {}).get("state") == "Fulfilled":
+        forgetSession(SID)
+    return [reply for i in response.get("messages") or [] for reply in toChatMessages(i)]
+
+def recognizeSession(lexClient, SID, texts):
+    # Lex keeps the dialog state per session, so its utterances must go one after another.
+    return [recognizeText(lexClient, SID, text) for text in texts]
+
+def recognizeMessages(lexClient, SID, messages):
+    """Sends every message to Lex and returns all the replies, in the order of the messages.
+
+    A message may carry its own sessionId. Messages of one session are sent in order,
+    different sessions are sent concurrently on lexPool.
+    """
+    sessions = OrderedDict()
+    for i in messages:
+        text = i.get("unstructured", {}).get("text")
+        if text:
+            sessions.setdefault(i.get("sessionId", SID), []).append(text)
+    if len(sessions) <= 1:
+        results = [recognizeSession(lexClient, sid, texts) for sid, texts in sessions.items()]
+    else:
+        futures = [lexPool.submit(recognizeSession, lexClient, sid, texts) for sid, texts in sessions.items()]
+        results = [future.result() for future in futures]
+
+    # Put the replies back in the order the messages came in.
+    pending = {sid: iter(result) for sid, result in zip(sessions, results)}
+    replies = []
+    for i in messages:
+        if i.get("unstructured", {}).get("text"):
+            replies.extend(next(pending[i.get("sessionId", SID)]))
+    return replies
+
 def lambda_handler(event, context=[]):
     print(json.dumps(event))
-    lexClient = boto3.client("lexv2-runtime")
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.Table('user-data')
+    lexClient = getClient("lexv2-runtime")
+    table = getResource('dynamodb').Table('user-data')
     SID = event.get('sessionId')
     messages = event.get("messages", None)
-    records = table.query(
-      KeyConditionExpression=Key('sessionid').eq(SID),
-    )
+    record = consumeSavedSearch(table, SID)
     
-    if(records['Count'] > 0) :
-        table.delete_item(
-            Key={
-                'sessionid': SID
-            }
-        )
-        a = createResponse(lexClient,records['Items'][0])
+    if record is not None:
+        a = createResponse(lexClient,record)
         print(json.dumps(a))
         return a
-    if messages is not None:
-        for i in messages:
-            response = lexClient.recognize_text(
-                botId = "V4X2CJY560",
-                botAliasId = "TSTALIASID",
-                localeId = "en_US",
-                sessionId = SID,
-                text = i["unstructured"]["text"],
-            )
-            print(json.dumps(response))
-            responseMsgs = response.get("messages", None)
-            retObj = {"statusCode": 200, "messages": []}
-            if responseMsgs:
-                for i in responseMsgs:
-                    retObj["messages"].append(
-                        {"type": "unstructured", "unstructured": {"text": i["content"]}}
-                    )
-                return retObj
+    replies = recognizeMessages(lexClient, SID, messages or [])
+    if replies:
+        return {"statusCode": 200, "messages": replies}
 
     return {
         "statusCode": 200,
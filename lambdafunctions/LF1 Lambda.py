@@ -1,14 +1,45 @@
-import boto3
-import datetime
-import dateutil.parser
+import hashlib
 import json
 import logging
 import math
 import os
+import queue
+import threading
 import time
-from botocore.vendored import requests
 import re
+from collections import OrderedDict
+# Only the standard library is imported here. LF1 runs on every user turn and the
+# validation path needs nothing else, so dateutil and boto3 are imported on first
+# use to keep cold starts short.
 EMAILREGEX = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b'
+EMAIL_PATTERN = re.compile(EMAILREGEX)
+ZIP_PATTERN = re.compile(r'\d{5}')
+CUISINES = frozenset(['italian', 'chinese', 'indian', 'greek', 'mexican', 'spanish','american','japanese'])
+LOCATIONS = frozenset(['new york', 'manhattan'])
+# The catalog only has Manhattan restaurants, whose zip codes are 10001 to 10282.
+# Used when no catalog snapshot is deployed to tell which zip codes are covered.
+MANHATTAN_ZIP_CODES = frozenset(f'{n:05d}' for n in range(10001, 10283))
+# Catalog snapshot built by otherscripts/exportSnapshot.py, its header lists the zip codes LF2 can place.
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'restaurants.snapshot'))
+SNAPSHOT_MAGIC = b'RSNAP1\n'
+
+QUEUE_URL = os.environ.get('QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/905418445552/dining-suggestion-queue')
+# A send not acknowledged after this long is sent a second time, so one slow connection does not set the turn latency.
+SQS_SEND_TIMEOUT_SECONDS = float(os.environ.get('SQS_SEND_TIMEOUT_SECONDS', 0.25))
+# Longest the confirmation turn waits for SQS before spilling the request to disk.
+SQS_SEND_DEADLINE_SECONDS = float(os.environ.get('SQS_SEND_DEADLINE_SECONDS', 3))
+SQS_RETRY_PAUSE_SECONDS = 0.05
+# How long the sender waits for more requests to fill a send_message_batch.
+SQS_LINGER_SECONDS = float(os.environ.get('SQS_LINGER_SECONDS', 0.002))
+# Sender threads, so one slow batch does not hold up the requests queued behind it.
+SQS_SENDERS = int(os.environ.get('SQS_SENDERS', 4))
+# Requests SQS did not take by the deadline, sent again by a later invocation of this execution environment.
+# Best effort only, /tmp is not shared and is lost when the environment is recycled, so the user is told.
+SQS_SPILL_PATH = os.environ.get('SQS_SPILL_PATH', '/tmp/sqs-spill.jsonl')
+# Idempotency keys already sent, so that a retried confirmation is not queued twice.
+SENT_KEYS_MAX = 1024
+# Show the recommendations in the chat on confirmation when the catalog snapshot is deployed with LF1.
+INLINE_RECOMMENDATIONS = os.environ.get('INLINE_RECOMMENDATIONS', 'true').lower() == 'true'
 
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -68,6 +99,7 @@ def elicit_slot(session_attributes, intent_name, slots, slot_to_elicit, message)
 
 
 def isvalid_date(date):
+    import dateutil.parser
     try:
         dateutil.parser.parse(date)
         return True
@@ -119,13 +151,238 @@ def delegate(intent_name,session_attributes, slots):
             }
         } 
     
-def push_to_sqs(location, cuisine, dining_time, num_people, email, sessionId):
-    # connect to SQS
-    sqs_client = boto3.client('sqs')
+""" --- SQS producer --- """
+
+
+class SqsProducer:
+    """
+    Sends requests to the dining suggestion queue through sender threads that
+    coalesce whatever is queued into send_message_batch calls on a warm client.
+    Lambda freezes the environment once the handler returns, so every send is
+    waited for within the invocation that made it. A request still not
+    acknowledged by the deadline is appended to a spill file, and stays there
+    until a later invocation gets it acknowledged. Only this execution environment
+    reads the file, so a spilled request is lost if it is recycled first.
+    """
+
+    def __init__(self, spill_path):
+        self.spill_path = spill_path
+        self.pending = queue.Queue()
+        self.sent = OrderedDict()
+        self.in_flight = {}
+        # key -> body of the requests in the spill file, None until the file is read.
+        self.spilled = None
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def warm(self):
+        """Creates the SQS client and the sender threads, before any send is timed."""
+        # boto3 is only loaded once a request is confirmed
+        from awsClients import getClient
+        getClient('sqs')
+        with self.lock:
+            while len(self.threads) < SQS_SENDERS:
+                thread = threading.Thread(target=self.run, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def send(self, body, key, hedge_after, deadline):
+        """
+        Queues a request and waits until SQS acknowledges it or deadline seconds pass.
+        A copy is sent again after every hedge_after seconds without an answer, or
+        after a failure, with at most two copies in flight. Both carry the same
+        IdempotencyKey, so LF2 drops the one that arrives second.
+        Returns 'sent', 'duplicate' or 'spilled'.
+        """
+        with self.lock:
+            if key in self.sent:
+                return 'duplicate'
+            entry = self.current_entry(body, key)
+        end = time.monotonic() + deadline
+        while not entry['ok'] and time.monotonic() < end:
+            if entry['done'].wait(min(hedge_after, max(0, end - time.monotonic()))) and not entry['ok']:
+                # Every copy failed, botocore already retried them, pause before the next one.
+                time.sleep(min(SQS_RETRY_PAUSE_SECONDS, max(0, end - time.monotonic())))
+            if not entry['ok'] and time.monotonic() < end:
+                self.attempt(entry)
+        if entry['ok']:
+            return 'sent'
+        self.spill(entry)
+        return 'spilled'
+
+    def current_entry(self, body, key):
+        # Called with the lock held. An entry older than the deadline was given up on by an
+        # earlier invocation, and its copies may be stuck in threads frozen since, so it is replaced.
+        entry = self.in_flight.get(key)
+        if entry is None or time.monotonic() - entry['created'] > SQS_SEND_DEADLINE_SECONDS:
+            entry = self.enqueue(body, key)
+        return entry
+
+    def enqueue(self, body, key):
+        # Called with the lock held.
+        entry = {'body': body, 'key': key, 'done': threading.Event(), 'ok': False, 'attempts': 1, 'created': time.monotonic()}
+        self.in_flight[key] = entry
+        self.pending.put(entry)
+        return entry
+
+    def attempt(self, entry):
+        """Sends another copy of an entry, unless it was acknowledged or two copies are in flight."""
+        with self.lock:
+            if entry['ok'] or entry['attempts'] >= 2:
+                return
+            entry['attempts'] += 1
+            entry['done'].clear()
+            self.in_flight.setdefault(entry['key'], entry)
+        self.pending.put(entry)
+
+    def run(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + SQS_LINGER_SECONDS
+            while len(batch) < 10:
+                try:
+                    batch.append(self.pending.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        from awsClients import getClient
+        try:
+            response = getClient('sqs').send_message_batch(
+                QueueUrl=QUEUE_URL,
+                Entries=[{
+                    'Id': str(i),
+                    'MessageBody': json.dumps(entry['body']),
+                    'MessageAttributes': {'IdempotencyKey': {'DataType': 'String', 'StringValue': entry['key']}},
+                } for i, entry in enumerate(batch)],
+            )
+            succeeded = {int(success['Id']) for success in response.get('Successful', [])}
+            for failure in response.get('Failed', []):
+                print(f"SQS rejected {batch[int(failure['Id'])]['key']} : {failure.get('Message')}")
+        except Exception as e:
+            print(f"Could not send {len(batch)} messages to SQS : {e}")
+            succeeded = set()
+        with self.lock:
+            for i, entry in enumerate(batch):
+                entry['attempts'] -= 1
+                if i in succeeded:
+                    self.acknowledge(entry)
+                if entry['ok'] or entry['attempts'] == 0:
+                    if self.in_flight.get(entry['key']) is entry:
+                        del self.in_flight[entry['key']]
+                    entry['done'].set()
+
+    def acknowledge(self, entry):
+        # Called with the lock held.
+        entry['ok'] = True
+        self.sent[entry['key']] = True
+        while len(self.sent) > SENT_KEYS_MAX:
+            self.sent.popitem(last=False)
+        if self.spilled and self.spilled.pop(entry['key'], None) is not None:
+            self.write_spill()
+
+    def load_spill(self):
+        # Called with the lock held.
+        if self.spilled is None:
+            self.spilled = {}
+            if os.path.exists(self.spill_path):
+                with open(self.spill_path) as f:
+                    for line in f:
+                        if line.strip():
+                            record = json.loads(line)
+                            self.spilled[record['key']] = record['body']
+
+    def write_spill(self):
+        # Called with the lock held. Rewritten whole, so a record only leaves the file once acknowledged.
+        if not self.spilled:
+            if os.path.exists(self.spill_path):
+                os.remove(self.spill_path)
+            return
+        tmp = self.spill_path + '.tmp'
+        with open(tmp, 'w') as f:
+            for key, body in self.spilled.items():
+                f.write(json.dumps({'body': body, 'key': key}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.spill_path)
+
+    def spill(self, entry):
+        with self.lock:
+            self.load_spill()
+            if entry['ok'] or entry['key'] in self.spilled:
+                return
+            self.spilled[entry['key']] = entry['body']
+            with open(self.spill_path, 'a') as f:
+                f.write(json.dumps({'body': entry['body'], 'key': entry['key']}) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
 
-    # SQS queue URL
-    queue_url = 'https://sqs.us-east-1.amazonaws.com/905418445552/dining-suggestion-queue'
+    def drain_spill(self):
+        """
+        Queues the spilled requests again and returns their entries, for the caller
+        to wait on. Their records stay in the file until one copy is acknowledged.
+        """
+        entries = []
+        with self.lock:
+            self.load_spill()
+            for key, body in list(self.spilled.items()):
+                if key not in self.sent:
+                    entries.append(self.current_entry(body, key))
+        return entries
+
+    def wait(self, entries, deadline):
+        """Waits at most deadline seconds for entries to be acknowledged. Returns how many were."""
+        end = time.monotonic() + deadline
+        for entry in entries:
+            entry['done'].wait(max(0, end - time.monotonic()))
+        return sum(1 for entry in entries if entry['ok'])
+
+
+producer = SqsProducer(SQS_SPILL_PATH)
+
+
+def idempotency_key(sessionId, message_body):
+    """Same key for the same session confirming the same slot values, so Lex retries are recognized."""
+    values = json.dumps([sessionId, sorted((k, v) for k, v in message_body.items() if k != 'sessionid')], default=str)
+    return hashlib.sha256(values.encode('utf8')).hexdigest()[:32]
+
+
+""" --- Inline recommendations --- """
+
+
+snapshot_state = {'loaded': False, 'snapshot': None}
+
+
+def inline_recommendations(location, cuisine, dining_time):
+    """Returns the top restaurants for a confirmed request from the catalog snapshot, or None when it has no answer."""
+    if not INLINE_RECOMMENDATIONS:
+        return None
+    # numpy and the snapshot are only loaded once a request is confirmed
+    try:
+        import restaurantSnapshot
+    except ImportError:
+        return None
+    if not snapshot_state['loaded']:
+        snapshot_state['snapshot'] = restaurantSnapshot.openSnapshot()
+        snapshot_state['loaded'] = True
+    key = restaurantSnapshot.requestKey({'cuisine': cuisine, 'location': location, 'dining_time': dining_time})
+    hits = restaurantSnapshot.snapshotRecommendations(snapshot_state['snapshot'], key)
+    if not hits:
+        return None
+    fields = ('name', 'address', 'rating', 'review_count', 'image_url', 'yelp_url', 'price_level', 'distance_km')
+    return [{field: hit['_source'].get(field) for field in fields} for hit in hits]
+
+
+def recommendations_payload(restaurants):
+    # Rendered as cards by LF0, see recommendationCards there.
+    return {
+        'contentType': 'CustomPayload',
+        'content': json.dumps({'type': 'recommendations', 'restaurants': restaurants}),
+    }
 
+
+def push_to_sqs(location, cuisine, dining_time, num_people, email, sessionId):
     # create message body
     message_body = {
         'sessionid': sessionId,
@@ -136,60 +393,122 @@ def push_to_sqs(location, cuisine, dining_time, num_people, email, sessionId):
         'email': email
     }
 
-    # send message to SQS queue
-    sqs_client.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(message_body),
-    )
-    print(f"sent message {message_body} to SQS")
+    # The client is created before the send is timed, a cold one takes longer than the timeout.
+    producer.warm()
+    # Earlier requests that SQS did not take in time go out in the same batches.
+    spilled = producer.drain_spill()
+    outcome = producer.send(message_body, idempotency_key(sessionId, message_body), SQS_SEND_TIMEOUT_SECONDS, SQS_SEND_DEADLINE_SECONDS)
+    if spilled:
+        # Nothing runs once the handler returns, so they are waited for here too.
+        print(f"Resent {producer.wait(spilled, SQS_SEND_DEADLINE_SECONDS)} of {len(spilled)} spilled messages")
+    print(f"{outcome} message {message_body} to SQS")
+    return outcome
+
+""" --- Slot rules, built once at import --- """
+
+
+LOCATION_MESSAGE = 'This location is not supported.'
+ZIP_COVERAGE_MESSAGE = 'We only have restaurants in Manhattan for now, and this zip code is outside of it. Please give a Manhattan zip code, or say Manhattan.'
+CUISINE_MESSAGE = 'Cuisine not available. Please try another.'
+PARTY_SIZE_MESSAGE = 'Maximum 20 people allowed. Try again'
+INVALID_TIME_MESSAGE = 'Incorrect time entered. Please try again!'
+CLOSED_TIME_MESSAGE = 'Our business hours are from 10 am to 9 pm. Can you please specify a time during this range?'
+EMAIL_MESSAGE = 'Can you please check your email address and try again?'
+
+
+zip_state = {'zip_codes': None}
+
+
+def covered_zip_codes():
+    """The zip codes of the snapshot's geo grid (its zip_centroids), or Manhattan's without a snapshot."""
+    if zip_state['zip_codes'] is None:
+        zip_codes = MANHATTAN_ZIP_CODES
+        # Only the JSON header is read, the snapshot's columns need numpy.
+        try:
+            if os.path.exists(SNAPSHOT_PATH):
+                with open(SNAPSHOT_PATH, 'rb') as f:
+                    if f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                        header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+                        zip_codes = frozenset(header.get('zip_centroids') or ()) or MANHATTAN_ZIP_CODES
+        except (OSError, ValueError) as e:
+            print(f"Could not read the zip codes of {SNAPSHOT_PATH} : {e}")
+        zip_state['zip_codes'] = zip_codes
+    return zip_state['zip_codes']
+
+
+def check_location(value):
+    if value.lower() in LOCATIONS:
+        return None
+    # A zip code lets LF2 rank restaurants by distance, see RANKING_MODE, as long as it can place it.
+    if ZIP_PATTERN.fullmatch(value):
+        return None if value in covered_zip_codes() else ZIP_COVERAGE_MESSAGE
+    return LOCATION_MESSAGE
+
+
+def check_cuisine(value):
+    return None if value.lower() in CUISINES else CUISINE_MESSAGE
+
+
+def check_party_size(value):
+    # Parsed like the original validator did, so '05', '+3' or ' 3' are still accepted.
+    size = parse_int(value)
+    return None if 0 <= size <= 20 else PARTY_SIZE_MESSAGE
+
+
+def check_dining_time(value):
+    parts = value.split(':')
+    if len(value) != 5 or len(parts) != 2:
+        return INVALID_TIME_MESSAGE
+    hour, minute = parse_int(parts[0]), parse_int(parts[1])
+    if math.isnan(hour) or math.isnan(minute) or hour > 23 or minute > 59:
+        return INVALID_TIME_MESSAGE
+    return None if 10 < hour < 21 else CLOSED_TIME_MESSAGE
+
+
+def check_email(value):
+    return None if EMAIL_PATTERN.fullmatch(value) else EMAIL_MESSAGE
+
+
+# (slot, values accepted without a check, check of any other value returning a message or None,
+#  message when the slot is required but empty). The accepted values are the common
+# spellings, so most filled slots cost one set lookup.
+# Checked in this order, the first violation is the slot Lex asks for again.
+SLOT_RULES = (
+    ('Location', LOCATIONS | {location.title() for location in LOCATIONS}, check_location, LOCATION_MESSAGE),
+    ('Cuisine', CUISINES | {cuisine.title() for cuisine in CUISINES}, check_cuisine, None),
+    ('NumberOfPeople', frozenset(str(n) for n in range(21)), check_party_size, None),
+    ('DiningTime', frozenset(f'{hour:02d}:{minute:02d}' for hour in range(11, 21) for minute in range(60)),
+     check_dining_time, None),
+    ('email', frozenset(), check_email, None),
+)
+
+
+def validate_slots(values):
+    """
+    Checks slot values, given in SLOT_RULES order, and returns the (slot, message) violations.
+    Stops at a required slot that is still empty, Lex asks for it before anything else.
+    """
+    violations = []
+    for (slot, accepted, check, missing_message), value in zip(SLOT_RULES, values):
+        if value is None:
+            if missing_message is not None:
+                violations.append((slot, missing_message))
+                break
+        elif value not in accepted:
+            message = check(value)
+            if message is not None:
+                violations.append((slot, message))
+    return violations
+
 
 def validate_dining_suggestion(location, cuisine, num_people, time, email):
-    cuisines = ['italian', 'chinese', 'indian', 'greek', 'mexican', 'spanish','american','japanese']
-    locations = ['new york', 'manhattan']
-    
-    if(location is None):
-        return build_validation_result(False,
-                                       "Location",
-                                       "This location is not supported.")
-        
-    elif (location.lower() not in locations):
-        return build_validation_result(False,
-                                       "Location",
-                                       "This location is not supported.")
-        
-    if cuisine is not None and cuisine.lower() not in cuisines:
-        return build_validation_result(False,
-                                       'Cuisine',
-                                       'Cuisine not available. Please try another.')
-
-    if num_people is not None:
-        num_people = int(num_people)
-        if num_people > 20 or num_people < 0:
-            return build_validation_result(False,
-                                           'NumberOfPeople',
-                                           'Maximum 20 people allowed. Try again')
-
-    if time is not None:
-        if len(time) != 5:
-            # Not a valid time; use a prompt defined on the build-time model.
-            return build_validation_result(False, 'DiningTime', "Incorrect time entered. Please try again!")
-
-        hour, minute = time.split(':')
-        hour = parse_int(hour)
-        minute = parse_int(minute)
-        if math.isnan(hour) or math.isnan(minute):
-            # Not a valid time; use a prompt defined on the build-time model.
-            return build_validation_result(False, 'DiningTime', 'Not a valid time')
-
-        if hour <= 10 or hour >= 21:
-            # Outside of business hours
-            return build_validation_result(False, 'DiningTime',
-                                           'Our business hours are from 10 am to 9 pm. Can you please specify a time during this range?')
-    if email is not None:
-        if(not re.fullmatch(EMAILREGEX, email)):
-            build_validation_result(False, 'email', 'Can you please check your email address and try again?')
-    
-    return build_validation_result(True, None, None)
+    violations = validate_slots((location, cuisine, num_people, time, email))
+    if not violations:
+        return build_validation_result(True, None, None)
+
+    result = build_validation_result(False, violations[0][0], ' '.join(message for _, message in violations))
+    result['violatedSlots'] = [slot for slot, _ in violations]
+    return result
 
 
 def get_slot_val(slot,to_get):
@@ -229,7 +548,8 @@ def dining_suggestion_intent(intent_request):
     elif(location == None or cuisine == None or num_people == None or time == None or email == None or confirmation != "Confirmed"):
         validation_result = validate_dining_suggestion(location, cuisine, num_people, time, email)   
         if not validation_result['isValid']:
-            slots[validation_result['violatedSlot']] = None
+            for violated_slot in validation_result['violatedSlots']:
+                slots[violated_slot] = None
             return elicit_slot(intent_request['sessionState']['sessionAttributes'],
                             intent_request['interpretations'][0]['intent']['name'],
                             slots,
@@ -245,7 +565,23 @@ def dining_suggestion_intent(intent_request):
     
     else:
         sessionId = intent_request.get('sessionId')
-        push_to_sqs(location,cuisine, time, num_people, email, sessionId)
+        restaurants = inline_recommendations(location, cuisine, time)
+        # The email is still sent, the chat only gets the recommendations sooner.
+        outcome = push_to_sqs(location,cuisine, time, num_people, email, sessionId)
+        if outcome == 'spilled':
+            # Not queued yet, and lost if this execution environment is recycled, so no email is promised.
+            content = "Thank you for confirming! " + ("Here are our top picks. " if restaurants else "") + \
+                      "Your email may be delayed, if it does not arrive please ask me again."
+        elif restaurants:
+            content = "Thank you for confirming! Here are our top picks, you will also receive them by email shortly."
+        else:
+            content = "Thank you for confirming, You will recieve the email shortly!"
+        messages = [{
+            "contentType": "PlainText",
+            "content": content
+        }]
+        if restaurants:
+            messages.append(recommendations_payload(restaurants))
         return {"sessionState": {
                     "dialogAction": {
                         "type": "Close"
@@ -255,10 +591,7 @@ def dining_suggestion_intent(intent_request):
                         "state": "Fulfilled"
                     }
                 },
-                "messages": [{
-                    "contentType": "PlainText",
-                    "content": "Thank you for confirming, You will recieve the email shortly!"
-                        }]
+                "messages": messages
                 }
         
 def dispatch(intent_request):
@@ -1,19 +1,59 @@
-import boto3
-from botocore.exceptions import ClientError
-import requests
 from opensearchpy import OpenSearch
+import asyncio
+import gzip
 import json
+import os
+import random
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from awsClients import getClient, getResource
+from emailDelivery import deliverEmails, emailStats
+from idempotency import claim, dedupStats, duplicateRate, messageKey, settle
+from restaurantSnapshot import RANKING_MODE, RESULT_SIZE, isOpen, openSnapshot, requestKey, snapshotRecommendations
 
-SENDER = "aakar.mutha@nyu.edu"
-AWS_REGION = "us-east-1"
+# SQS queue URL
+QUEUE_URL = os.environ.get('QUEUE_URL', 'https://sqs.us-east-1.amazonaws.com/905418445552/dining-suggestion-queue')
+# Most messages handled by one manual drain. A single receive returns at most 10,
+# larger windows are filled with repeated receives.
+BATCH_WINDOW = int(os.environ.get('BATCH_WINDOW', 10))
+POLL_WAIT_SECONDS = int(os.environ.get('POLL_WAIT_SECONDS', 20))
 
-# The subject line for the email.
-SUBJECT = "Delicious Food awaits you."
+# Recommendation cache, kept across warm invocations.
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 3600))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 256))
+# How often the index version marker written by the ingest is re-read.
+VERSION_CHECK_SECONDS = int(os.environ.get('VERSION_CHECK_SECONDS', 60))
+# A failed message is hidden for RETRY_BASE_SECONDS * 2 ** (receives - 1) seconds, with jitter,
+# up to RETRY_MAX_SECONDS, instead of coming back after the queue's visibility timeout.
+RETRY_BASE_SECONDS = int(os.environ.get('RETRY_BASE_SECONDS', 30))
+RETRY_MAX_SECONDS = int(os.environ.get('RETRY_MAX_SECONDS', 900))
+# After this many receives a failed message is moved to DLQ_URL, replay it with otherscripts/replayDeadLetters.py.
+# Without DLQ_URL it keeps being retried, until the queue's own redrive policy moves it.
+MAX_RECEIVES = int(os.environ.get('MAX_RECEIVES', 5))
+DLQ_URL = os.environ.get('DLQ_URL')
+# A message whose request another worker is handling is hidden this long, it was not processed
+# so it is neither backed off nor dead lettered.
+BUSY_RETRY_SECONDS = int(os.environ.get('BUSY_RETRY_SECONDS', 15))
+# 'sync' handles the steps of a batch one after another, 'async' overlaps them on an event loop.
+WORKER_MODE = os.environ.get('WORKER_MODE', 'sync')
+# Messages the async worker handles at the same time.
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 16))
 
 host = 'search-cloud-hw-1-43gl3ui4fy5t6aqdiv2ddgoo7a.aos.us-east-1.on.aws' # cluster endpoint, for example: my-test-domain.us-east-1.es.amazonaws.com
 region = 'us-east-1'
 service = 'aos'
 auth = ('cloud', 'Cloud-hw1') 
+INDEX = 'restaurant-index'
+# Oldest schema of restaurant-index that the filtered top-k query works on, see dynamoDBtoOpenSearch.py.
+SCHEMA_VERSION = 2
+# Hits fetched from OpenSearch per search, so that enough are left once the closed ones are dropped.
+SEARCH_CANDIDATES = int(os.environ.get('SEARCH_CANDIDATES', 25))
+# Top lists precomputed by otherscripts/materializeTopN.py, read before searching OpenSearch.
+# Set TOPN_TABLE to read them from DynamoDB, otherwise they are read from TOPN_DIR when it exists.
+TOPN_TABLE = os.environ.get('TOPN_TABLE')
+TOPN_DIR = os.environ.get('TOPN_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'topn'))
 client = OpenSearch(
         hosts = [{'host': host, 'port': 443}],
         http_compress = True, # enables gzip compression for request bodies
@@ -24,9 +64,23 @@ client = OpenSearch(
         ssl_show_warn = False
     )
 
-def queryElasticSearch(cuisine):
-    query = {
-        'size': 5,
+def buildQuery(cuisine):
+    if (indexState['schemaVersion'] or 0) >= SCHEMA_VERSION:
+        # cuisine is a keyword and the index is sorted by rating, so this is a
+        # non-scoring filter that can stop after the first hits of each segment.
+        return {
+            'size': SEARCH_CANDIDATES,
+            'query': {
+                'bool': {
+                    'filter': [{'term': {'cuisine': cuisine}}]
+                }
+            },
+            'sort': [{'rating': {'order': 'desc'}}],
+            'track_total_hits': False
+        }
+    # Index built before the managed mappings.
+    return {
+        'size': SEARCH_CANDIDATES,
         'query': {
             'multi_match': {
             'query': cuisine,
@@ -39,92 +93,542 @@ def queryElasticSearch(cuisine):
             }
         }
     }
-    response = client.search(
-        body = query,
-        index = 'restaurant-index'
-    )
-    
-    return response['hits']['hits']
 
-def sendEmail(hits,email):
-    message = "Hi, following are the restaurants we recommend according to your recent interaction:\n"
+def msearchBody(keys):
+    # The catalog only covers Manhattan, so the location does not narrow the query yet.
+    body = []
+    for cuisine, location in keys:
+        body.append({'index': INDEX})
+        body.append(buildQuery(cuisine))
+    return body
+
+def msearchResults(keys, response):
+    results = {}
+    for key, result in zip(keys, response['responses']):
+        if 'error' in result:
+            print(f"Search for {key} failed : {result['error']}")
+            results[key] = None
+        else:
+            results[key] = result['hits']['hits']
+    return results
+
+def queryElasticSearchBatch(keys):
+    """Runs the searches for several normalized (cuisine, location) keys in one _msearch.
+
+    Returns a dict mapping every key to its hits, or to None when that search failed.
+    """
+    keys = list(keys)
+    return msearchResults(keys, client.msearch(body = msearchBody(keys)))
+
+async def queryElasticSearchBatchAsync(keys):
+    """queryElasticSearchBatch on the AsyncOpenSearch client."""
+    keys = list(keys)
+    return msearchResults(keys, await getAsyncClient().msearch(body = msearchBody(keys)))
+
+snapshot = openSnapshot()
 
-    counter = 1
-    for i in hits:
-        data = i['_source']
-        message += f"{counter}. " + data['name'] + " located at " + data['address'] + "\n"
-        counter+=1
+# normalized (cuisine, location) -> (expires at, hits), least recently used first.
+recommendationCache = OrderedDict()
+cacheStats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+indexState = {'version': None, 'schemaVersion': None, 'checkedAt': None}
 
-        message += "Thank you for using RestaurantBot!\nSee you again (:"
-        print(message)
-        
-    CHARSET = "UTF-8"
+def getIndexMeta():
+    response = client.indices.get_mapping(index = INDEX)
+    mappings = next(iter(response.values()))['mappings']
+    return mappings.get('_meta', {})
 
-    # Create a new SES resource and specify a region.
-    client = boto3.client('ses',region_name=AWS_REGION)
+def checkIndexVersion(now):
+    """Reads the index metadata written by the ingest.
 
+    Drops every cached recommendation once a new index version shows up, and
+    records the schema version that decides which query buildQuery sends.
+    """
+    if indexState['checkedAt'] is not None and now - indexState['checkedAt'] < VERSION_CHECK_SECONDS:
+        return
+    indexState['checkedAt'] = now
     try:
-        #Provide the contents of the email.
-        response = client.send_email(
-            Destination={
-                'ToAddresses': [
-                    email,
-                ],
-            },
-            Message={
-                'Body': {
-                    'Text': {
-                        'Charset': CHARSET,
-                        'Data': message,
-                    },
-                },
-                'Subject': {
-                    'Charset': CHARSET,
-                    'Data': SUBJECT,
-                },
-            },
-            Source=SENDER,
-        )
-    # Display an error if something goes wrong.	
-    except ClientError as e:
-        print(e.response['Error']['Message'])
-    else:
-        print("Email sent! Message ID:"),
-        print(response['MessageId'])
+        meta = getIndexMeta()
+    except Exception as e:
+        print(f"Could not read the index version : {e}")
+        return
+    schemaVersion = meta.get('schema_version', 0)
+    if schemaVersion != indexState['schemaVersion'] and schemaVersion < SCHEMA_VERSION:
+        print(f"{INDEX} has schema version {schemaVersion}, expected at least {SCHEMA_VERSION}. Using the full text query.")
+    indexState['schemaVersion'] = schemaVersion
+    version = meta.get('index_version')
+    if version != indexState['version']:
+        if recommendationCache:
+            recommendationCache.clear()
+            cacheStats['invalidations'] += 1
+        indexState['version'] = version
+
+def cacheGet(key, now):
+    entry = recommendationCache.get(key)
+    if entry is None or entry[0] <= now:
+        if entry is not None:
+            del recommendationCache[key]
+        cacheStats['misses'] += 1
+        return None
+    recommendationCache.move_to_end(key)
+    cacheStats['hits'] += 1
+    return entry[1]
+
+def cachePut(key, hits, now):
+    recommendationCache[key] = (now + CACHE_TTL_SECONDS, hits)
+    recommendationCache.move_to_end(key)
+    while len(recommendationCache) > CACHE_MAX_ENTRIES:
+        recommendationCache.popitem(last = False)
+        cacheStats['evictions'] += 1
+
+def viewKeys(search):
+    # The exact location first, then the lists kept for a location that cannot be placed.
+    cuisine, location = search
+    return [f"{cuisine}|{location}", f"{cuisine}|"]
+
+def viewHits(cuisine, variants):
+    """OpenSearch shaped hits of the RANKING_MODE list of a view."""
+    entries = variants.get(RANKING_MODE) or variants.get('rating') or []
+    return [{'_id': f"{entry['id']}-{cuisine}", '_source': dict(entry, cuisine = cuisine)} for entry in entries]
+
+def readViewsFromTable(keys):
+    found = {}
+    dynamodb = getClient('dynamodb')
+    for start in range(0, len(keys), 100):
+        request = {TOPN_TABLE: {'Keys': [{'view_key': {'S': key}} for key in keys[start:start + 100]],
+                                'ProjectionExpression': 'view_key, variants'}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems = request)
+            for item in response['Responses'].get(TOPN_TABLE, []):
+                found[item['view_key']['S']] = json.loads(item['variants']['S'])
+            request = response.get('UnprocessedKeys')
+    return found
 
+def readViewsFromDirectory(keys):
+    found = {}
+    for key in keys:
+        path = os.path.join(TOPN_DIR, quote(key, safe = '') + '.json.gz')
+        if os.path.exists(path):
+            with gzip.open(path, 'rt', encoding = 'utf8') as f:
+                found[key] = json.load(f)['variants']
+    return found
+
+def readViews(searches):
+    """Returns the precomputed hits of every (cuisine, location) search that has a view.
+
+    All the views of a batch are read with one BatchGetItem, or one small file each.
+    """
+    if not searches or not (TOPN_TABLE or os.path.isdir(TOPN_DIR)):
+        return {}
+    keys = sorted({key for search in searches for key in viewKeys(search)})
+    try:
+        found = readViewsFromTable(keys) if TOPN_TABLE else readViewsFromDirectory(keys)
+    except Exception as e:
+        print(f"Could not read the precomputed views : {e}")
+        return {}
+    results = {}
+    for search in searches:
+        key = next((key for key in viewKeys(search) if key in found), None)
+        if key is not None:
+            results[search] = viewHits(search[0], found[key])
+    return results
+
+def planRecommendations(keys):
+    """Answers what the snapshot, the precomputed views and the cache can, and lists the (cuisine, location) searches left for OpenSearch."""
+    plan = {'results': {}, 'remaining': [], 'searches': {}, 'missing': [], 'now': time.monotonic()}
+    for key in keys:
+        hits = snapshotRecommendations(snapshot, key)
+        if hits is None:
+            plan['remaining'].append(key)
+        else:
+            plan['results'][key] = hits
+    if not plan['remaining']:
+        return plan
+
+    plan['searches'] = readViews({key[:2] for key in plan['remaining']})
+    unanswered = {key[:2] for key in plan['remaining']} - set(plan['searches'])
+    if not unanswered:
+        return plan
+    checkIndexVersion(plan['now'])
+    for search in unanswered:
+        hits = cacheGet(search, plan['now'])
+        if hits is None:
+            plan['missing'].append(search)
+        else:
+            plan['searches'][search] = hits
+    return plan
+
+def completeRecommendations(plan, found):
+    """Caches the searches found in OpenSearch and filters every remaining key's hits down to what is open."""
+    for search, hits in found.items():
+        plan['searches'][search] = hits
+        if hits is not None:
+            cachePut(search, hits, plan['now'])
+    results = plan['results']
+    for key in plan['remaining']:
+        hits = plan['searches'].get(key[:2])
+        results[key] = None if hits is None else [hit for hit in hits if isOpen(hit, key[2])][:RESULT_SIZE]
+    return results
+
+def fetchRecommendations(keys):
+    """Returns the hits of every (cuisine, location, open at) key.
+
+    They come from the local snapshot when there is one, then from the precomputed
+    views, then from the cache, and what is left is searched in OpenSearch with
+    one _msearch. Searches are cached
+    per (cuisine, location) and the restaurants closed at the requested time are
+    dropped afterwards.
+    When the _msearch fails, only the keys it was needed for get None.
+    """
+    plan = planRecommendations(keys)
+    found = {}
+    if plan['missing']:
+        try:
+            found = queryElasticSearchBatch(plan['missing'])
+        except Exception as e:
+            print(f"Batch search failed : {e}")
+    return completeRecommendations(plan, found)
+
+async def fetchRecommendationsAsync(keys):
+    """fetchRecommendations with the _msearch sent on the AsyncOpenSearch client."""
+    plan = planRecommendations(keys)
+    found = {}
+    if plan['missing']:
+        try:
+            found = await queryElasticSearchBatchAsync(plan['missing'])
+        except Exception as e:
+            print(f"Batch search failed : {e}")
+    return completeRecommendations(plan, found)
 
 def saveUserState(body):
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('user-data')
+    table = getResource('dynamodb').Table('user-data')
     response = table.put_item(
         Item=body
     )
     print(response)
 
-def lambda_handler(event,context):
-    sqs_client = boto3.client('sqs')
+def saveUserStateItem(body):
+    # The low level client is thread safe, unlike the Table resource, so the
+    # async worker can save from several threads at once.
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+    getClient('dynamodb').put_item(
+        TableName='user-data',
+        Item={name: serializer.serialize(value) for name, value in body.items()}
+    )
+
+def parseMessage(record):
+    """Normalizes an SQS event source record or a receive_message entry."""
+    return {
+        'messageId': record.get('messageId', record.get('MessageId')),
+        'receiptHandle': record.get('receiptHandle', record.get('ReceiptHandle')),
+        'body': record.get('body', record.get('Body')),
+        'attributes': record.get('attributes', record.get('Attributes', {})),
+        'messageAttributes': record.get('messageAttributes', record.get('MessageAttributes', {})),
+        'queueUrl': queueUrl(record.get('eventSourceARN')),
+    }
 
-    # SQS queue URL
-    queue_url = 'https://sqs.us-east-1.amazonaws.com/905418445552/dining-suggestion-queue'
+def queueUrl(arn):
+    """The URL of the queue an event source record comes from, QUEUE_URL for a manual drain."""
+    if not arn:
+        return QUEUE_URL
+    _, _, _, region, account, name = arn.split(':')
+    return f"https://sqs.{region}.amazonaws.com/{account}/{name}"
 
-    # Receive messages from the queue
-    response = sqs_client.receive_message(
-        QueueUrl=queue_url,
-        AttributeNames=['All'],
-    )
-    print(json.dumps(response))
-    messages = response.get('Messages',None)
-    
-    if(messages != None):
-        for message in messages:
-            sqs_client.delete_message(
-                QueueUrl=queue_url,
-                ReceiptHandle=message['ReceiptHandle']
-            )
-            body = json.loads(message.get('Body',None))
-            if(body != None):
-                saveUserState(body)
-                cuisine = body.get('cuisine', None)
-                email = body.get('email', None)
-                hits = queryElasticSearch(cuisine)
-                sendEmail(hits,email)
\ No newline at end of file
+def parseBody(message):
+    try:
+        body = json.loads(message['body'])
+    except (TypeError, ValueError):
+        body = None
+    if not isinstance(body, dict):
+        print(f"Skipping malformed message {message['messageId']}")
+        return None
+    return body
+
+def claimMessages(messages):
+    """Parses a batch and drops the requests already handled, before any work is done.
+
+    Returns the (message, body, request key) entries to process and the ids of the
+    messages to retry later, because another worker is still handling their request.
+    A request already done, or seen earlier in the same batch, is treated as handled.
+    """
+    entries = {}
+    for message in messages:
+        body = parseBody(message)
+        if body is None:
+            continue
+        if not isinstance(body.get('email'), str) or not body['email'].strip():
+            # No retry can add the address, so it is treated as handled like a malformed body.
+            print(f"Skipping message {message['messageId']}, it has no email address")
+            continue
+        key = messageKey(message, body)
+        if key in entries:
+            # Its first copy in the batch stands for it, and is retried if it fails.
+            dedupStats['messages'] += 1
+            dedupStats['duplicates'] += 1
+            continue
+        entries[key] = (message, body)
+    outcomes = claim(list(entries))
+    admitted = []
+    busy = []
+    for key, (message, body) in entries.items():
+        if outcomes[key] == 'busy':
+            busy.append(message['messageId'])
+        elif outcomes[key] == 'duplicate':
+            print(f"Skipping message {message['messageId']}, its request was already handled")
+        else:
+            admitted.append((message, body, key))
+    return admitted, busy
+
+def settleMessages(admitted, failed):
+    failed = set(failed)
+    settle([key for message, _, key in admitted if message['messageId'] not in failed],
+           [key for message, _, key in admitted if message['messageId'] in failed])
+
+def processBatch(messages):
+    """Processes every message of a batch and returns the ids of the ones that failed,
+    and of the ones left for later because another worker holds their request.
+
+    Recommendations come from the snapshot or the cache, and the remaining searches of the batch go
+    to OpenSearch in a single _msearch, one per distinct (cuisine, location). The
+    results are then fanned back out to the messages, without the restaurants
+    closed at the dining time the user asked for.
+    A message whose body is missing, not valid JSON or without an email address can
+    never succeed, so it is logged and treated as handled instead of being redelivered forever.
+    Redelivered requests are dropped first by claimMessages.
+    The emails of the batch are sent together by deliverEmails.
+    """
+    admitted, busy = claimMessages(messages)
+    failed = []
+    pending = []
+    for message, body, _ in admitted:
+        try:
+            saveUserState(body)
+        except Exception as e:
+            print(f"Failed to save the state of message {message['messageId']} : {e}")
+            failed.append(message['messageId'])
+            continue
+        # Computed once, the open at part depends on the current day.
+        pending.append((message, body, requestKey(body)))
+
+    keys = {key for _, _, key in pending}
+    results = {}
+    if keys:
+        try:
+            results = fetchRecommendations(keys)
+        except Exception as e:
+            print(f"Batch search failed : {e}")
+
+    deliveries = []
+    for message, body, key in pending:
+        hits = results.get(key)
+        if hits is None:
+            print(f"Failed to process message {message['messageId']} : No search results")
+            failed.append(message['messageId'])
+        else:
+            deliveries.append((message['messageId'], body.get('email', None), hits))
+    failed.extend(deliverEmails(deliveries))
+    settleMessages(admitted, failed)
+    return failed, busy
+
+asyncState = {'loop': None, 'client': None}
+
+def getAsyncClient():
+    """The AsyncOpenSearch client, created on the worker's event loop and reused by warm invocations."""
+    if asyncState['client'] is None:
+        # Only the async worker needs it, and it pulls in aiohttp.
+        from opensearchpy import AsyncOpenSearch
+        asyncState['client'] = AsyncOpenSearch(
+            hosts = [{'host': host, 'port': 443}],
+            http_compress = True,
+            http_auth = auth,
+            use_ssl = True,
+            verify_certs = True,
+            ssl_assert_hostname = False,
+            ssl_show_warn = False
+        )
+    return asyncState['client']
+
+def runAsync(coroutine):
+    # One loop for the life of the execution environment, so the async client keeps its connections.
+    if asyncState['loop'] is None:
+        asyncState['loop'] = asyncio.new_event_loop()
+        # boto3 calls are offloaded to threads, one per message that can be in flight.
+        asyncState['loop'].set_default_executor(ThreadPoolExecutor(max_workers = ASYNC_CONCURRENCY))
+    return asyncState['loop'].run_until_complete(coroutine)
+
+async def processBatchAsync(messages):
+    """processBatch on an event loop, returning the ids of the messages that failed and of the busy ones.
+
+    The user state of every message is saved while the batch's searches run, at
+    most ASYNC_CONCURRENCY boto3 calls at a time. The emails of the messages
+    whose state was saved then go out together, as in processBatch.
+    """
+    semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+
+    async def offload(function, *args):
+        async with semaphore:
+            return await asyncio.to_thread(function, *args)
+
+    admitted, busy = await offload(claimMessages, messages)
+    failed = []
+    pending = [(message, body, requestKey(body)) for message, body, _ in admitted]
+    saves = [asyncio.ensure_future(offload(saveUserStateItem, body)) for _, body, _ in pending]
+
+    keys = {key for _, _, key in pending}
+    results = {}
+    if keys:
+        try:
+            results = await fetchRecommendationsAsync(keys)
+        except Exception as e:
+            print(f"Batch search failed : {e}")
+
+    deliveries = []
+    outcomes = await asyncio.gather(*saves, return_exceptions = True)
+    for (message, body, key), outcome in zip(pending, outcomes):
+        hits = results.get(key)
+        if isinstance(outcome, Exception):
+            print(f"Failed to save the state of message {message['messageId']} : {outcome}")
+            failed.append(message['messageId'])
+        elif hits is None:
+            print(f"Failed to process message {message['messageId']} : No search results")
+            failed.append(message['messageId'])
+        else:
+            deliveries.append((message['messageId'], body.get('email', None), hits))
+    failed.extend(await offload(deliverEmails, deliveries))
+    await offload(settleMessages, admitted, failed)
+    return failed, busy
+
+def handleBatch(messages):
+    if WORKER_MODE == 'async':
+        return runAsync(processBatchAsync(messages))
+    return processBatch(messages)
+
+def receiveMessages(sqs_client):
+    """Long polls the queue until BATCH_WINDOW messages are collected or it runs dry."""
+    messages = []
+    waitTime = POLL_WAIT_SECONDS
+    while len(messages) < BATCH_WINDOW:
+        response = sqs_client.receive_message(
+            QueueUrl=QUEUE_URL,
+            AttributeNames=['All'],
+            MessageAttributeNames=['All'],
+            MaxNumberOfMessages=min(10, BATCH_WINDOW - len(messages)),
+            WaitTimeSeconds=waitTime,
+        )
+        received = response.get('Messages', [])
+        if not received:
+            break
+        messages.extend(parseMessage(m) for m in received)
+        # Only the first receive waits, the rest just drain what is already queued.
+        waitTime = 0
+    return messages
+
+def deleteMessages(sqs_client, messages):
+    for start in range(0, len(messages), 10):
+        chunk = messages[start:start + 10]
+        response = sqs_client.delete_message_batch(
+            QueueUrl=QUEUE_URL,
+            Entries=[
+                {'Id': str(i), 'ReceiptHandle': m['receiptHandle']}
+                for i, m in enumerate(chunk)
+            ]
+        )
+        for failure in response.get('Failed', []):
+            print(f"Could not delete message {chunk[int(failure['Id'])]['messageId']} : {failure.get('Message')}")
+
+retryStats = {'retried': 0, 'busy': 0, 'dead_lettered': 0}
+
+def retryDelay(receiveCount):
+    """Exponential backoff with equal jitter, so retries of a failing batch spread out instead of returning together."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** max(0, receiveCount - 1))
+    return int(delay / 2 + random.uniform(0, delay / 2))
+
+def receiveCount(message):
+    return int(message['attributes'].get('ApproximateReceiveCount', 1))
+
+def sendableAttributes(attributes):
+    """Message attributes of an event source record or a received message, as send_message takes them."""
+    sendable = {}
+    for name, attribute in (attributes or {}).items():
+        value = attribute.get('stringValue', attribute.get('StringValue'))
+        if value is not None:
+            sendable[name] = {'DataType': attribute.get('dataType', attribute.get('DataType', 'String')), 'StringValue': value}
+    return sendable
+
+def deadLetter(sqs_client, message):
+    attributes = sendableAttributes(message['messageAttributes'])
+    attributes['SourceQueueUrl'] = {'DataType': 'String', 'StringValue': message['queueUrl']}
+    attributes['ReceiveCount'] = {'DataType': 'Number', 'StringValue': str(receiveCount(message))}
+    sqs_client.send_message(QueueUrl=DLQ_URL, MessageBody=message['body'], MessageAttributes=attributes)
+
+def scheduleRetries(sqs_client, messages, busy = ()):
+    """Delays the retry of every failed message and returns the ones that are still to be retried.
+
+    A message received MAX_RECEIVES times or more is moved to DLQ_URL instead and
+    counts as handled, so that it is deleted from the queue. The messages whose ids
+    are in busy were never processed, another worker holds their request, so they
+    come back after BUSY_RETRY_SECONDS and are never dead lettered.
+    """
+    retries = []
+    for message in messages:
+        if DLQ_URL and message['messageId'] not in busy and receiveCount(message) >= MAX_RECEIVES:
+            try:
+                deadLetter(sqs_client, message)
+                retryStats['dead_lettered'] += 1
+                print(f"Moved message {message['messageId']} to the dead letter queue after {receiveCount(message)} receives")
+                continue
+            except Exception as e:
+                print(f"Could not dead letter message {message['messageId']} : {e}")
+        retries.append(message)
+
+    byQueue = {}
+    for message in retries:
+        byQueue.setdefault(message['queueUrl'], []).append(message)
+    for url, queued in byQueue.items():
+        for start in range(0, len(queued), 10):
+            chunk = queued[start:start + 10]
+            try:
+                response = sqs_client.change_message_visibility_batch(
+                    QueueUrl=url,
+                    Entries=[
+                        {'Id': str(i), 'ReceiptHandle': m['receiptHandle'],
+                         'VisibilityTimeout': BUSY_RETRY_SECONDS if m['messageId'] in busy else retryDelay(receiveCount(m))}
+                        for i, m in enumerate(chunk)
+                    ]
+                )
+            except Exception as e:
+                # They come back after the queue's visibility timeout instead.
+                print(f"Could not delay {len(chunk)} retries : {e}")
+                continue
+            delayed = {int(success['Id']) for success in response.get('Successful', [])}
+            retryStats['busy'] += sum(1 for i in delayed if chunk[i]['messageId'] in busy)
+            retryStats['retried'] += sum(1 for i in delayed if chunk[i]['messageId'] not in busy)
+            for failure in response.get('Failed', []):
+                print(f"Could not delay message {chunk[int(failure['Id'])]['messageId']} : {failure.get('Message')}")
+    return retries
+
+def lambda_handler(event,context):
+    records = (event or {}).get('Records')
+    if records:
+        # Invoked by the SQS event source mapping. Failed messages are reported back
+        # so that only they return to the queue (requires ReportBatchItemFailures).
+        messages = [parseMessage(r) for r in records]
+        failed, busy = handleBatch(messages)
+        retry = set(failed) | set(busy)
+        # Failed messages come back after a backoff, or go to the dead letter queue.
+        failed = [m['messageId'] for m in scheduleRetries(getClient('sqs'), [m for m in messages if m['messageId'] in retry], set(busy))]
+        print(f"Cache stats : {cacheStats}, email stats : {emailStats}, "
+              f"dedup stats : {dedupStats} ({duplicateRate():.1%} duplicates), retry stats : {retryStats}")
+        return {'batchItemFailures': [{'itemIdentifier': i} for i in failed]}
+
+    # Manual drain: poll the queue ourselves and delete only what succeeded.
+    sqs_client = getClient('sqs')
+    messages = receiveMessages(sqs_client)
+    print(f"Received {len(messages)} messages")
+    failed, busy = handleBatch(messages)
+    retry = set(failed) | set(busy)
+    failed = {m['messageId'] for m in scheduleRetries(sqs_client, [m for m in messages if m['messageId'] in retry], set(busy))}
+    print(f"Cache stats : {cacheStats}, email stats : {emailStats}, "
+          f"dedup stats : {dedupStats} ({duplicateRate():.1%} duplicates), retry stats : {retryStats}")
+    deleteMessages(sqs_client, [m for m in messages if m['messageId'] not in failed])
+    return {'processed': len(messages) - len(failed), 'failed': len(failed)}
@@ -0,0 +1,71 @@
+"""Shared boto3 clients and resources for the Lambda functions.
+
+Clients are created on first use and kept for the lifetime of the execution
+environment, so warm invocations reuse their connection pools instead of paying
+for a new client and a fresh TLS handshake on every call. Deploy this file next
+to each handler (or in a layer).
+"""
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+# Sends every call to a local stand-in instead of AWS, e.g. a moto server on http://localhost:5000
+LOCAL_ENDPOINT_URL = os.environ.get('LOCAL_ENDPOINT_URL')
+
+CONFIG = Config(
+    region_name = AWS_REGION,
+    max_pool_connections = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 25)),
+    tcp_keepalive = True,
+    connect_timeout = float(os.environ.get('AWS_CONNECT_TIMEOUT', 2)),
+    read_timeout = float(os.environ.get('AWS_READ_TIMEOUT', 10)),
+    retries = {
+        'mode': os.environ.get('AWS_RETRY_MODE', 'standard'),
+        'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 3)),
+    },
+)
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_resources = {}
+
+def _getSession():
+    # The default boto3 session is not safe to build from several threads at once.
+    global _session
+    if _session is None:
+        _session = boto3.session.Session(region_name=AWS_REGION)
+    return _session
+
+def getClient(service):
+    """Returns the shared client for a service, creating it on first use. Clients are thread safe."""
+    client = _clients.get(service)
+    if client is None:
+        with _lock:
+            client = _clients.get(service)
+            if client is None:
+                client = _getSession().client(service, config=CONFIG, endpoint_url=LOCAL_ENDPOINT_URL)
+                _clients[service] = client
+    return client
+
+def getResource(service):
+    """Returns the shared resource for a service. Resources are not thread safe, use them from one thread."""
+    resource = _resources.get(service)
+    if resource is None:
+        with _lock:
+            resource = _resources.get(service)
+            if resource is None:
+                resource = _getSession().resource(service, config=CONFIG, endpoint_url=LOCAL_ENDPOINT_URL)
+                _resources[service] = resource
+    return resource
+
+def reset():
+    """Forgets every client, e.g. after changing LOCAL_ENDPOINT_URL in a test."""
+    global _session, LOCAL_ENDPOINT_URL
+    with _lock:
+        LOCAL_ENDPOINT_URL = os.environ.get('LOCAL_ENDPOINT_URL')
+        _session = None
+        _clients.clear()
+        _resources.clear()
@@ -0,0 +1,193 @@
+# Recommendation emails for LF2. Every distinct list of restaurants in a batch is
+# rendered once, and the users who get the same list share one send. Deploy it next to LF2.
+import html
+import json
+import os
+import random
+import smtplib
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from string import Template
+from botocore.exceptions import ClientError
+from awsClients import getClient
+
+SENDER = "aakar.mutha@nyu.edu"
+
+# The subject line for the email.
+SUBJECT = "Delicious Food awaits you."
+CHARSET = "UTF-8"
+
+# 'ses' sends through SES, 'smtp' through SMTP_HOST:SMTP_PORT, for example a local
+# `python -m aiosmtpd -n -l localhost:1025` while testing.
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'ses')
+SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 1025))
+# SES takes at most 50 recipients per message.
+MAX_RECIPIENTS = 50
+# Recipients per second allowed by the SES account (see GetSendQuota), shared by the sends of a batch.
+SES_MAX_SEND_RATE = float(os.environ.get('SES_MAX_SEND_RATE', 14))
+# Tries of a throttled send, every retry pauses all the sends of the batch with exponential backoff.
+SEND_ATTEMPTS = int(os.environ.get('SEND_ATTEMPTS', 4))
+SEND_BACKOFF_SECONDS = 0.5
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'TooManyRequestsException')
+# SES rejects the whole message when one of its addresses is refused.
+REJECTION_CODES = ('MessageRejected',)
+
+TEXT_TEMPLATE = Template(
+    "Hi, following are the restaurants we recommend according to your recent interaction:\n"
+    "${restaurants}"
+    "Thank you for using RestaurantBot!\nSee you again (:"
+)
+TEXT_ROW = Template("$number. $name located at $address\n")
+HTML_TEMPLATE = Template(
+    "<html><body>"
+    "<p>Hi, following are the restaurants we recommend according to your recent interaction:</p>"
+    "<ol>$restaurants</ol>"
+    "<p>Thank you for using RestaurantBot!<br>See you again (:</p>"
+    "</body></html>"
+)
+HTML_ROW = Template("<li>$name located at $address</li>")
+HTML_LINKED_ROW = Template('<li><a href="$url">$name</a> located at $address</li>')
+
+emailStats = {'renders': 0, 'sends': 0, 'recipients': 0, 'empty': 0, 'throttles': 0}
+
+def renderKey(hits):
+    """Identifies a list of restaurants, messages with the same key get the same email."""
+    return tuple(hit.get('_id') or json.dumps(hit['_source'], sort_keys = True, default = str) for hit in hits)
+
+def renderBodies(hits):
+    """Returns the text and HTML bodies of the email for a list of restaurant hits."""
+    textRows = []
+    htmlRows = []
+    for number, hit in enumerate(hits, 1):
+        data = hit['_source']
+        name = data.get('name', '')
+        address = data.get('address', '')
+        textRows.append(TEXT_ROW.substitute(number = number, name = name, address = address))
+        if data.get('yelp_url'):
+            htmlRows.append(HTML_LINKED_ROW.substitute(url = html.escape(data['yelp_url']), name = html.escape(name),
+                                                       address = html.escape(address)))
+        else:
+            htmlRows.append(HTML_ROW.substitute(name = html.escape(name), address = html.escape(address)))
+    emailStats['renders'] += 1
+    return TEXT_TEMPLATE.substitute(restaurants = ''.join(textRows)), HTML_TEMPLATE.substitute(restaurants = ''.join(htmlRows))
+
+def buildMessage(text, body):
+    """A multipart/alternative message addressed to undisclosed recipients, since several users get the same one."""
+    message = MIMEMultipart('alternative')
+    message['Subject'] = SUBJECT
+    message['From'] = SENDER
+    message['To'] = 'undisclosed-recipients:;'
+    message.attach(MIMEText(text, 'plain', CHARSET))
+    message.attach(MIMEText(body, 'html', CHARSET))
+    return message.as_bytes()
+
+class SendRateLimiter:
+    """Spaces sends so that the recipients per second stay within SES_MAX_SEND_RATE."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, recipients):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + recipients / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def backoff(self, attempt):
+        """Holds every send back after a throttle, longer after each one, with jitter."""
+        delay = SEND_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1)
+        with self.lock:
+            self.next = max(self.next, time.monotonic()) + delay
+
+rateLimiter = SendRateLimiter(SES_MAX_SEND_RATE)
+
+def sendRaw(raw, recipients):
+    """Sends one message and returns the recipients the server refused while accepting the others."""
+    rateLimiter.wait(len(recipients))
+    refused = []
+    if EMAIL_BACKEND == 'smtp':
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as smtp:
+            refused = list(smtp.sendmail(SENDER, recipients, raw))
+    else:
+        response = getClient('ses').send_raw_email(Source = SENDER, Destinations = recipients, RawMessage = {'Data': raw})
+        print(f"Email sent to {len(recipients)} recipients! Message ID: {response['MessageId']}")
+    emailStats['sends'] += 1
+    emailStats['recipients'] += len(recipients) - len(refused)
+    return refused
+
+def isThrottle(e):
+    if isinstance(e, ClientError):
+        return e.response['Error']['Code'] in THROTTLE_CODES
+    # 4xx replies are temporary, the server asks to try again later.
+    return isinstance(e, smtplib.SMTPResponseException) and 400 <= e.smtp_code < 500
+
+def isRejection(e):
+    """Whether the send failed because of some of its addresses rather than the message or the service."""
+    if isinstance(e, ClientError):
+        return e.response['Error']['Code'] in REJECTION_CODES
+    return isinstance(e, smtplib.SMTPRecipientsRefused)
+
+def sendToGroup(raw, recipients):
+    """Sends one message to recipients, MAX_RECIPIENTS at a time, and returns the ones it could not reach.
+
+    A throttled send is retried as a whole after a backoff shared by every send
+    of the batch, up to SEND_ATTEMPTS times. SES rejects the whole call when one
+    address is refused, so only a rejected multi-recipient send is retried one
+    recipient at a time. Any other failure fails the whole chunk.
+    """
+    failed = []
+    for start in range(0, len(recipients), MAX_RECIPIENTS):
+        chunk = recipients[start:start + MAX_RECIPIENTS]
+        attempt = 0
+        while True:
+            try:
+                failed.extend(sendRaw(raw, chunk))
+                break
+            except Exception as e:
+                if isThrottle(e) and attempt + 1 < SEND_ATTEMPTS:
+                    emailStats['throttles'] += 1
+                    rateLimiter.backoff(attempt)
+                    attempt += 1
+                    continue
+                print(f"Could not send to {len(chunk)} recipients : {e}")
+                if len(chunk) > 1 and isRejection(e):
+                    for recipient in chunk:
+                        failed.extend(sendToGroup(raw, [recipient]))
+                else:
+                    failed.extend(chunk)
+                break
+    return failed
+
+def deliverEmails(deliveries):
+    """
+    Emails every (id, email, hits) delivery and returns the ids that could not be sent.
+    The body of each distinct list of hits is rendered once and sent in one
+    message to up to MAX_RECIPIENTS users. Nothing is sent for an empty list of
+    hits, when every restaurant is closed at the dining time, and it does not fail.
+    """
+    groups = {}
+    failed = []
+    for deliveryId, email, hits in deliveries:
+        if not email:
+            failed.append(deliveryId)
+            continue
+        if not hits:
+            print(f"No open restaurant to email for {deliveryId}")
+            emailStats['empty'] += 1
+            continue
+        key = renderKey(hits)
+        if key not in groups:
+            groups[key] = {'hits': hits, 'recipients': {}}
+        groups[key]['recipients'].setdefault(email, []).append(deliveryId)
+
+    for group in groups.values():
+        raw = buildMessage(*renderBodies(group['hits']))
+        for email in sendToGroup(raw, list(group['recipients'])):
+            failed.extend(group['recipients'][email])
+    return failed
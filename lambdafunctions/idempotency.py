@@ -0,0 +1,192 @@
+# Recognizes SQS redeliveries of a request LF2 already handled, before any search,
+# save or email is repeated. Deploy it next to LF2.
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from awsClients import getClient
+
+# Conditional writes record which requests are in progress or done, create it with
+# otherscripts/createDedupTable.py. Set DEDUP_TABLE to an empty string to only use the warm window.
+DEDUP_TABLE = os.environ.get('DEDUP_TABLE', 'recommendation-requests')
+# How long a done request is remembered, the table's TTL deletes it afterwards.
+DEDUP_TTL_SECONDS = int(os.environ.get('DEDUP_TTL_SECONDS', 86400))
+# How long a claim holds off other workers, after that a crashed worker's request can be taken over.
+DEDUP_LEASE_SECONDS = int(os.environ.get('DEDUP_LEASE_SECONDS', 300))
+# Done requests remembered by a warm execution environment, answered without calling DynamoDB.
+DEDUP_WINDOW = int(os.environ.get('DEDUP_WINDOW', 4096))
+# Conditional writes in flight at once.
+DEDUP_CONCURRENCY = int(os.environ.get('DEDUP_CONCURRENCY', 10))
+THROTTLE_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+# Identifies the claims of this execution environment, only the owner completes or releases them.
+CLAIM_ID = uuid.uuid4().hex
+# request key -> time it is remembered until, oldest first.
+doneWindow = OrderedDict()
+# Request keys claimed in the table and not settled yet.
+ownClaims = set()
+dedupStats = {'messages': 0, 'duplicates': 0, 'window_hits': 0, 'table_hits': 0, 'in_progress': 0,
+              'claimed': 0, 'released': 0, 'store_errors': 0}
+executor = ThreadPoolExecutor(max_workers = DEDUP_CONCURRENCY)
+
+def messageKey(message, body):
+    """The IdempotencyKey attribute LF1 sets on the message, or else a hash of the request."""
+    attribute = (message.get('messageAttributes') or {}).get('IdempotencyKey') or {}
+    key = attribute.get('stringValue') or attribute.get('StringValue')
+    if key:
+        return key
+    return hashlib.sha256(json.dumps(body, sort_keys = True, default = str).encode('utf8')).hexdigest()[:32]
+
+def duplicateRate():
+    return dedupStats['duplicates'] / dedupStats['messages'] if dedupStats['messages'] else 0.0
+
+def remember(key, now):
+    doneWindow[key] = now + DEDUP_TTL_SECONDS
+    doneWindow.move_to_end(key)
+    while len(doneWindow) > DEDUP_WINDOW:
+        doneWindow.popitem(last = False)
+
+def inWindow(key, now):
+    until = doneWindow.get(key)
+    if until is None:
+        return False
+    if until <= now:
+        del doneWindow[key]
+        return False
+    return True
+
+def claimOne(key, now):
+    """Conditionally records the request as in progress.
+
+    Returns 'claimed', 'duplicate' when it is already done, 'busy' when another
+    worker holds it or the table is throttled, in which case it should be retried
+    later, or 'unrecorded' when the table cannot be used at all.
+    """
+    try:
+        getClient('dynamodb').put_item(
+            TableName = DEDUP_TABLE,
+            Item = {
+                'request_key': {'S': key},
+                'state': {'S': 'in_progress'},
+                'claim_id': {'S': CLAIM_ID},
+                'lease_until': {'N': str(int(now + DEDUP_LEASE_SECONDS))},
+                'expires_at': {'N': str(int(now + DEDUP_TTL_SECONDS))},
+            },
+            ConditionExpression = 'attribute_not_exists(request_key) OR expires_at < :now OR (#state = :inProgress AND lease_until < :now)',
+            ExpressionAttributeNames = {'#state': 'state'},
+            ExpressionAttributeValues = {':now': {'N': str(int(now))}, ':inProgress': {'S': 'in_progress'}},
+            ReturnValuesOnConditionCheckFailure = 'ALL_OLD',
+        )
+        return 'claimed'
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code == 'ConditionalCheckFailedException':
+            return heldState(key, e.response.get('Item'))
+        if code in THROTTLE_CODES:
+            print(f"Dedup table throttled, retrying {key} later")
+            return 'busy'
+        error = e
+    except Exception as e:
+        # Connection errors and timeouts are BotoCoreErrors, not ClientErrors.
+        error = e
+    # Without the table the request is handled anyway, at least once beats never.
+    print(f"Could not claim {key} : {error}")
+    dedupStats['store_errors'] += 1
+    return 'unrecorded'
+
+def heldState(key, item):
+    """'duplicate' when the request someone claimed is done, else 'busy'."""
+    if item is None:
+        try:
+            item = getClient('dynamodb').get_item(TableName = DEDUP_TABLE, Key = {'request_key': {'S': key}},
+                                                  ConsistentRead = True).get('Item', {})
+        except Exception as e:
+            # Someone holds it, so it is safer to retry later than to handle it twice.
+            print(f"Could not read the claim of {key} : {e}")
+            dedupStats['store_errors'] += 1
+            return 'busy'
+    return 'duplicate' if item.get('state', {}).get('S') == 'done' else 'busy'
+
+def claim(keys):
+    """
+    Claims every request key of a batch.
+    Args:
+        keys : list of distinct request keys
+    Returns:
+        dict : key -> 'claimed', 'unrecorded' (process it, the table could not record it), 'duplicate' or 'busy'
+    """
+    dedupStats['messages'] += len(keys)
+    now = time.time()
+    outcomes = {}
+    toClaim = []
+    for key in keys:
+        if inWindow(key, now):
+            outcomes[key] = 'duplicate'
+            dedupStats['window_hits'] += 1
+        elif DEDUP_TABLE:
+            toClaim.append(key)
+        else:
+            outcomes[key] = 'unrecorded'
+    for key, outcome in zip(toClaim, executor.map(lambda key: claimOne(key, now), toClaim)):
+        outcomes[key] = outcome
+        if outcome == 'duplicate':
+            dedupStats['table_hits'] += 1
+            remember(key, now)
+        elif outcome == 'busy':
+            dedupStats['in_progress'] += 1
+        elif outcome == 'claimed':
+            dedupStats['claimed'] += 1
+            ownClaims.add(key)
+    dedupStats['duplicates'] += sum(1 for outcome in outcomes.values() if outcome == 'duplicate')
+    return outcomes
+
+def completeOne(key, now):
+    getClient('dynamodb').update_item(
+        TableName = DEDUP_TABLE,
+        Key = {'request_key': {'S': key}},
+        UpdateExpression = 'SET #state = :done, expires_at = :expires REMOVE lease_until',
+        ConditionExpression = 'claim_id = :claim',
+        ExpressionAttributeNames = {'#state': 'state'},
+        ExpressionAttributeValues = {':done': {'S': 'done'}, ':expires': {'N': str(int(now + DEDUP_TTL_SECONDS))},
+                                     ':claim': {'S': CLAIM_ID}},
+    )
+
+def releaseOne(key):
+    getClient('dynamodb').delete_item(
+        TableName = DEDUP_TABLE,
+        Key = {'request_key': {'S': key}},
+        ConditionExpression = 'claim_id = :claim',
+        ExpressionAttributeValues = {':claim': {'S': CLAIM_ID}},
+    )
+
+def settle(done, failed):
+    """
+    Marks the requests that were handled as done, and releases the claims of the
+    ones that failed so that their redelivery is handled again.
+    Args:
+        done : list of request keys handled
+        failed : list of request keys to handle again
+    """
+    now = time.time()
+    for key in done:
+        remember(key, now)
+    tasks = [(completeOne, (key, now)) for key in done if key in ownClaims]
+    tasks += [(releaseOne, (key,)) for key in failed if key in ownClaims]
+    ownClaims.difference_update(done)
+    ownClaims.difference_update(failed)
+
+    def run(task):
+        function, args = task
+        try:
+            function(*args)
+            return function is releaseOne
+        except Exception as e:
+            # A claim left in progress is taken over once its lease runs out.
+            print(f"Could not settle {args[0]} : {e}")
+            dedupStats['store_errors'] += 1
+            return False
+    dedupStats['released'] += sum(executor.map(run, tasks))
@@ -0,0 +1,227 @@
+# Recommendations ranked from the catalog snapshot, shared by LF1 (inline
+# recommendations) and LF2 (emailed recommendations). Deploy it next to both.
+import datetime
+import json
+import os
+from zoneinfo import ZoneInfo
+try:
+    import numpy as np
+except ImportError:
+    # Without numpy there is no snapshot, recommendations come from OpenSearch.
+    np = None
+
+RESULT_SIZE = 5
+# Where the restaurants are, the dining time is a wall clock time there.
+TIMEZONE = ZoneInfo(os.environ.get('TIMEZONE', 'America/New_York'))
+# Opening hours are bitmaps of half hours, see hoursBitmap in otherscripts/yelpToDynamoDB.py.
+SLOT_MINUTES = 30
+# Catalog snapshot built by otherscripts/exportSnapshot.py and deployed next to the functions.
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'restaurants.snapshot'))
+SNAPSHOT_MAGIC = b'RSNAP1\n'
+# 'rating' ranks by rating alone, 'geo' blends it with the distance from the user's location.
+RANKING_MODE = os.environ.get('RANKING_MODE', 'rating')
+# Rating points a restaurant loses per km away from the user in 'geo' mode.
+GEO_DISTANCE_WEIGHT = float(os.environ.get('GEO_DISTANCE_WEIGHT', 0.5))
+MAX_RATING = 5.0
+# Largest search window around the user before a geo query scans the whole cuisine.
+GEO_MAX_WINDOW_KM = 50
+# Below this many rows a numpy scan of the cuisine beats the grid search (see otherscripts/benchGeoRanking.py).
+GEO_GRID_MIN_ROWS = int(os.environ.get('GEO_GRID_MIN_ROWS', 8000))
+EARTH_RADIUS_KM = 6371.0
+# Where a location named in the chat is, when it is not a zip code found in the catalog.
+LOCATION_CENTROIDS = {
+    'manhattan': (40.7831, -73.9712),
+    'new york': (40.7128, -74.0060),
+}
+
+def normalizeQuery(cuisine, location):
+    return ((cuisine or '').strip().lower(), (location or '').strip().lower())
+
+def openAt(diningTime, now=None):
+    """Returns the (weekday, half hour) of an HH:MM dining time today, or None when there is no valid time."""
+    try:
+        hour, minute = (int(part) for part in diningTime.split(':'))
+    except (AttributeError, ValueError):
+        return None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        return None
+    today = now or datetime.datetime.now(TIMEZONE)
+    return (today.weekday(), (hour * 60 + minute) // SLOT_MINUTES)
+
+def requestKey(body):
+    """The normalized (cuisine, location, open at) a message asks recommendations for."""
+    return normalizeQuery(body.get('cuisine'), body.get('location')) + (openAt(body.get('dining_time')),)
+
+def isOpen(hit, at):
+    """Whether a hit is open at a (weekday, half hour). Restaurants whose hours are unknown count as open."""
+    hours = hit['_source'].get('hours')
+    if at is None or not hours:
+        return True
+    # int(), the bitmaps of an index loaded from Decimals may have come back as floats.
+    return bool((int(hours[at[0]]) >> at[1]) & 1)
+
+def loadSnapshot(path):
+    """Memory maps every column of a snapshot file, see otherscripts/exportSnapshot.py for the layout."""
+    with open(path, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a restaurant snapshot")
+        header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+    columns = {
+        name: np.memmap(path, dtype = column['dtype'], mode = 'r', offset = column['offset'], shape = tuple(column['shape']))
+        for name, column in header['columns'].items()
+    }
+    return {'header': header, 'columns': columns}
+
+def snapshotHit(snap, row):
+    """Builds an OpenSearch shaped hit for one row, so callers do not care where it came from."""
+    header, columns = snap['header'], snap['columns']
+    offsets, strings = columns['string_offsets'], columns['strings']
+    fields = header['string_fields']
+    source = {}
+    for i, field in enumerate(fields):
+        position = row * len(fields) + i
+        source[field] = bytes(strings[offsets[position]:offsets[position + 1]]).decode('utf8')
+    source['cuisine'] = header['cuisines'][columns['cuisine'][row]]
+    # Stored as float32, rounded back to the half stars Yelp gives so it prints as 4.5 and not 4.500000095.
+    source['rating'] = round(float(columns['rating'][row]), 1)
+    source['review_count'] = int(columns['review_count'][row])
+    source['latitude'] = float(columns['latitude'][row])
+    source['longitude'] = float(columns['longitude'][row])
+    source['zip_code'] = f"{columns['zip_code'][row]:05d}" if columns['zip_code'][row] else None
+    if 'hours' in columns:
+        source['hours'] = [int(day) for day in columns['hours'][row]]
+        source['price_level'] = int(columns['price_level'][row]) or None
+    return {'_id': f"{source['id']}-{source['cuisine']}", '_source': source}
+
+def openRows(snap, rows, at):
+    """The rows open at a (weekday, half hour), checked with one shift and mask per row."""
+    if at is None or 'hours' not in snap['columns']:
+        return rows
+    bits = (snap['columns']['hours'][rows, at[0]] >> np.uint64(at[1])) & np.uint64(1)
+    return rows[bits.astype(bool)]
+
+def snapshotTopK(snap, cuisine, k=5, at=None):
+    """Returns the k best rated restaurants of a cuisine open at `at`, or None when the snapshot does not have it."""
+    span = snap['header']['cuisine_ranges'].get(cuisine)
+    if span is None:
+        return None
+    start, end = span
+    rows = openRows(snap, np.arange(start, end), at)
+    rating = np.nan_to_num(snap['columns']['rating'][rows], nan = 0.0)
+    reviews = snap['columns']['review_count'][rows]
+    # Highest rating first, more reviews first among equal ratings.
+    score = rating.astype(np.float64) * 1e7 + reviews
+    if len(score) > k:
+        # Only the k best need ordering, argpartition finds them in linear time.
+        candidates = np.argpartition(-score, k - 1)[:k]
+    else:
+        candidates = np.arange(len(score))
+    order = candidates[np.argsort(-score[candidates], kind = 'stable')]
+    return [snapshotHit(snap, int(rows[i])) for i in order]
+
+def locatePoint(snap, location):
+    """Returns the (latitude, longitude) of a location name or zip code, or None."""
+    centroid = snap['header'].get('zip_centroids', {}).get(location)
+    if centroid is not None:
+        return tuple(centroid)
+    return LOCATION_CENTROIDS.get(location)
+
+def distancesKm(latitude, longitude, latitudes, longitudes):
+    # Equirectangular approximation, well within a meter at city scale.
+    x = np.radians(longitudes.astype(np.float64) - longitude) * np.cos(np.radians(latitude))
+    y = np.radians(latitudes.astype(np.float64) - latitude)
+    return EARTH_RADIUS_KM * np.sqrt(x * x + y * y)
+
+def geoRows(snap, start, end, latitude, longitude, rings):
+    """Rows of [start, end) whose grid cell is at most `rings` cells away from the point.
+
+    Rows are sorted by cell within a cuisine, so every latitude band of the window
+    is one contiguous run found with two binary searches.
+    """
+    header = snap['header']
+    cells = snap['columns']['geo_cell'][start:end]
+    size, offset = header['geo_cell_degrees'], header['geo_cell_offset']
+    row = int(np.floor(latitude / size)) + offset
+    column = int(np.floor(longitude / size)) + offset
+    runs = []
+    for band in range(row - rings, row + rings + 1):
+        low = np.searchsorted(cells, (band << 18) | (column - rings), 'left')
+        high = np.searchsorted(cells, (band << 18) | (column + rings), 'right')
+        if low < high:
+            runs.append(np.arange(low, high))
+    return start + np.concatenate(runs) if runs else np.empty(0, dtype = np.int64)
+
+def geoTopK(snap, cuisine, latitude, longitude, k, ratingWeight, distanceWeight, radiusKm = None, at = None):
+    """Returns [(row, distance km)] of the k best rows by ratingWeight * rating - distanceWeight * distance.
+
+    The search window grows ring by ring around the point and stops as soon as no
+    row outside of it could beat the k-th best one found inside.
+    """
+    span = snap['header']['cuisine_ranges'].get(cuisine)
+    if span is None:
+        return None
+    start, end = span
+    columns = snap['columns']
+    # Smallest distance covered by one ring, east-west cells shrink with the latitude.
+    ringKm = np.radians(snap['header']['geo_cell_degrees']) * EARTH_RADIUS_KM * np.cos(np.radians(abs(latitude) + 1))
+    rings = 1
+    while True:
+        covered = rings * ringKm
+        # Past this window, or for a small cuisine, a scan of the whole cuisine is as cheap.
+        exhaustive = covered > GEO_MAX_WINDOW_KM or end - start < GEO_GRID_MIN_ROWS
+        rows = np.arange(start, end) if exhaustive else geoRows(snap, start, end, latitude, longitude, rings)
+        rows = openRows(snap, rows, at)
+        distances = distancesKm(latitude, longitude, columns['latitude'][rows], columns['longitude'][rows])
+        distances = np.nan_to_num(distances, nan = np.inf)
+        if radiusKm is not None:
+            keep = distances <= radiusKm
+            rows, distances = rows[keep], distances[keep]
+        score = ratingWeight * np.nan_to_num(columns['rating'][rows].astype(np.float64), nan = 0.0) - distanceWeight * distances
+        if len(score) > k:
+            best = np.argpartition(-score, k - 1)[:k]
+        else:
+            best = np.arange(len(score))
+        complete = exhaustive or (radiusKm is not None and covered >= radiusKm)
+        if complete or (len(best) == k and score[best].min() >= ratingWeight * MAX_RATING - distanceWeight * covered):
+            best = best[np.argsort(-score[best], kind = 'stable')]
+            return [(int(rows[i]), float(distances[i])) for i in best]
+        rings *= 2
+
+def snapshotNearby(snap, cuisine, location, k=5, at=None):
+    """Top k of a cuisine open at `at` by rating blended with the distance from the user's location."""
+    point = locatePoint(snap, location)
+    if point is None:
+        return snapshotTopK(snap, cuisine, k, at)
+    found = geoTopK(snap, cuisine, point[0], point[1], k, 1.0, GEO_DISTANCE_WEIGHT, at = at)
+    if found is None:
+        return None
+    hits = []
+    for row, distance in found:
+        hit = snapshotHit(snap, row)
+        hit['_source']['distance_km'] = round(distance, 2)
+        hits.append(hit)
+    return hits
+
+def snapshotNearest(snap, cuisine, latitude, longitude, k=5, radiusKm=None):
+    """The k restaurants of a cuisine closest to a point, optionally only within radiusKm."""
+    return geoTopK(snap, cuisine, latitude, longitude, k, 0.0, 1.0, radiusKm)
+
+def openSnapshot():
+    if np is None or not os.path.exists(SNAPSHOT_PATH):
+        return None
+    try:
+        snap = loadSnapshot(SNAPSHOT_PATH)
+    except Exception as e:
+        print(f"Could not load the snapshot {SNAPSHOT_PATH} : {e}")
+        return None
+    print(f"Loaded {snap['header']['count']} restaurants from {SNAPSHOT_PATH}")
+    return snap
+
+def snapshotRecommendations(snap, key):
+    """Top RESULT_SIZE hits of a (cuisine, location, open at) key in RANKING_MODE, or None when the snapshot cannot answer it."""
+    if snap is None:
+        return None
+    cuisine, location, at = key
+    if RANKING_MODE == 'geo':
+        return snapshotNearby(snap, cuisine, location, RESULT_SIZE, at)
+    return snapshotTopK(snap, cuisine, RESULT_SIZE, at)
@@ -0,0 +1,36 @@
+import argparse
+import os
+import tempfile
+import time
+import pyarrow.compute as pc
+from dynamoDBtoOpenSearch import scanTable
+from exportCatalog import FORMATS, catalogItems, openCatalog, writeCatalog
+
+def timed(load):
+    start = time.monotonic()
+    result = load()
+    return time.monotonic() - start, result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares loading the restaurants from a Scan with loading them from a catalog export. '
+                                                 'Uses the table of the usual AWS configuration, set AWS_ENDPOINT_URL_DYNAMODB for a local one.')
+    parser.add_argument('--segments', type=int, default=4, help='Parallel Scan segments.')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    scanTime, items = min((timed(lambda: list(scanTable(args.segments))) for _ in range(args.repeat)), key=lambda run: run[0])
+    print(f"Scan                {len(items)} items in {scanTime * 1000:8.1f} ms")
+
+    directory = tempfile.mkdtemp()
+    for format in FORMATS:
+        path = os.path.join(directory, format)
+        writeCatalog(path, items, format)
+        # As the reindexer and the snapshot export read it, one dict per restaurant.
+        rowsTime, rows = min((timed(lambda: list(catalogItems(path))) for _ in range(args.repeat)), key=lambda run: run[0])
+        # As an analysis reads it, whole typed columns.
+        tableTime, table = min((timed(lambda: openCatalog(path).to_table()) for _ in range(args.repeat)), key=lambda run: run[0])
+        queryTime, _ = min((timed(lambda: openCatalog(path).to_table(columns=['rating'], filter=pc.field('cuisine') == 'indian')
+                                  .column('rating').to_numpy().mean()) for _ in range(args.repeat)), key=lambda run: run[0])
+        print(f"{format:8s} as dicts    {len(rows)} items in {rowsTime * 1000:8.1f} ms ({scanTime / rowsTime:.1f}x faster)")
+        print(f"{format:8s} as columns  {table.num_rows} rows  in {tableTime * 1000:8.1f} ms ({scanTime / tableTime:.1f}x faster)")
+        print(f"{format:8s} mean rating of one cuisine in {queryTime * 1000:.1f} ms")
@@ -0,0 +1,63 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+import numpy as np
+from exportSnapshot import buildColumns, writeSnapshot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions'))
+import restaurantSnapshot as ranking
+
+def syntheticDocs(count, seed=0):
+    """Restaurants scattered over Manhattan with Yelp-like ratings."""
+    rng = random.Random(seed)
+    return [{
+        'id': f'r{i}', 'cuisine': 'indian', 'name': f'Restaurant {i}', 'address': f'{i} Broadway',
+        'rating': rng.choice([3.0, 3.5, 4.0, 4.5, 5.0]), 'review_count': rng.randint(0, 3000),
+        'latitude': rng.uniform(40.70, 40.88), 'longitude': rng.uniform(-74.02, -73.91),
+    } for i in range(count)]
+
+def bruteForce(snap, latitude, longitude, k, ratingWeight, distanceWeight):
+    """Scores every row of the cuisine, the baseline for the grid search."""
+    start, end = snap['header']['cuisine_ranges']['indian']
+    columns = snap['columns']
+    distances = ranking.distancesKm(latitude, longitude, columns['latitude'][start:end], columns['longitude'][start:end])
+    score = ratingWeight * columns['rating'][start:end].astype(np.float64) - distanceWeight * distances
+    best = np.argpartition(-score, k - 1)[:k]
+    best = best[np.argsort(-score[best], kind='stable')]
+    return [(start + int(i), float(distances[i])) for i in best]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the grid geo ranking of LF2 with a brute force scan.')
+    parser.add_argument('--rows', type=int, default=1000, help='Restaurants of the benchmarked cuisine.')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.snapshot')
+    writeSnapshot(path, *buildColumns(syntheticDocs(args.rows)))
+    snap = ranking.loadSnapshot(path)
+    threshold = ranking.GEO_GRID_MIN_ROWS
+    # Measure the grid search itself, whatever the size LF2 would switch to a scan at.
+    ranking.GEO_GRID_MIN_ROWS = 0
+    rng = random.Random(1)
+    points = [(rng.uniform(40.71, 40.87), rng.uniform(-74.01, -73.92)) for _ in range(args.queries)]
+
+    modes = {
+        'nearest': (0.0, 1.0),
+        'blended': (1.0, ranking.GEO_DISTANCE_WEIGHT),
+    }
+    for mode, (ratingWeight, distanceWeight) in modes.items():
+        for lat, lon in points:
+            grid = ranking.geoTopK(snap, 'indian', lat, lon, args.k, ratingWeight, distanceWeight)
+            brute = bruteForce(snap, lat, lon, args.k, ratingWeight, distanceWeight)
+            assert [round(d, 6) for _, d in grid] == [round(d, 6) for _, d in brute], (mode, lat, lon)
+        gridTime = min(timeit.repeat(lambda: [ranking.geoTopK(snap, 'indian', lat, lon, args.k, ratingWeight, distanceWeight)
+                                               for lat, lon in points], number=1, repeat=5)) / len(points)
+        bruteTime = min(timeit.repeat(lambda: [bruteForce(snap, lat, lon, args.k, ratingWeight, distanceWeight)
+                                                for lat, lon in points], number=1, repeat=5)) / len(points)
+        print(f"{mode:8s} {args.rows} rows: grid {gridTime * 1e6:.1f} us, brute force {bruteTime * 1e6:.1f} us "
+              f"({bruteTime / gridTime:.2f}x), same results")
+    print(f"LF2 scans instead of searching the grid below {threshold} rows per cuisine.")
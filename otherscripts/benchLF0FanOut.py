@@ -0,0 +1,86 @@
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+LF0_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'LF0 lambda.py')
+
+class StubLex:
+    """
+    Stands in for the lexv2-runtime client. Every recognize_text call sleeps for a
+    latency drawn from a log-normal model of Lex response times and records the
+    order in which each session's utterances arrived.
+    """
+    def __init__(self, median_ms, sigma, seed=0):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.seen = {}
+
+    def recognize_text(self, botId, botAliasId, localeId, sessionId, text):
+        with self.lock:
+            delay = self.median * self.random.lognormvariate(0, self.sigma)
+            self.seen.setdefault(sessionId, []).append(text)
+        time.sleep(delay)
+        return {'messages': [{'content': f'reply to {text}'}], 'sessionState': {'intent': {'state': 'InProgress'}}}
+
+class StubTable:
+    def delete_item(self, **kwargs):
+        return {}
+
+def loadLF0(lex):
+    # LF0 gets its clients from awsClients, replace it before loading the handler.
+    stub = types.ModuleType('awsClients')
+    stub.getClient = lambda service: lex
+    stub.getResource = lambda service: types.SimpleNamespace(Table=lambda name: StubTable())
+    sys.modules['awsClients'] = stub
+    spec = importlib.util.spec_from_file_location('lf0', LF0_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.print = lambda *args, **kwargs: None
+    return module
+
+def buildEvent(sessions, per_session):
+    messages = []
+    for turn in range(per_session):
+        for s in range(sessions):
+            messages.append({'type': 'unstructured', 'sessionId': f's{s}',
+                             'unstructured': {'text': f's{s} utterance {turn}'}})
+    return {'sessionId': 's0', 'messages': messages}
+
+def serial(lex, event):
+    """What LF0 did before: one recognize_text after another."""
+    for message in event['messages']:
+        lex.recognize_text(botId='', botAliasId='', localeId='', sessionId=message['sessionId'],
+                           text=message['unstructured']['text'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares serial and fanned out Lex calls in LF0 with a stubbed Lex latency.')
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--per-session', type=int, default=3)
+    parser.add_argument('--median-ms', type=float, default=80)
+    parser.add_argument('--sigma', type=float, default=0.5)
+    args = parser.parse_args()
+
+    event = buildEvent(args.sessions, args.per_session)
+    lex = StubLex(args.median_ms, args.sigma)
+    start = time.perf_counter()
+    serial(lex, event)
+    serialTime = time.perf_counter() - start
+
+    lex = StubLex(args.median_ms, args.sigma)
+    lf0 = loadLF0(lex)
+    start = time.perf_counter()
+    response = lf0.lambda_handler(event)
+    fanOutTime = time.perf_counter() - start
+
+    ordered = all(texts == [f'{sid} utterance {t}' for t in range(args.per_session)] for sid, texts in lex.seen.items())
+    print(f"{len(event['messages'])} messages, {args.sessions} sessions, {lf0.LEX_MAX_WORKERS} workers")
+    print(f"Serial : {serialTime * 1000:.1f} ms")
+    print(f"Fan out: {fanOutTime * 1000:.1f} ms ({serialTime / fanOutTime:.2f}x), "
+          f"{len(response['messages'])} replies, per session order kept: {ordered}")
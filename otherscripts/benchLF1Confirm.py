@@ -0,0 +1,91 @@
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+
+LF1_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'LF1 Lambda.py')
+
+class StubSqs:
+    """
+    Stands in for the SQS client. Every call sleeps for a latency drawn from a
+    log-normal model of SQS response times, so a few calls land in the long tail.
+    """
+    def __init__(self, median_ms, sigma, seed=0):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def delay(self):
+        with self.lock:
+            self.calls += 1
+            return self.median * self.random.lognormvariate(0, self.sigma)
+
+    def send_message(self, QueueUrl, MessageBody):
+        time.sleep(self.delay())
+        return {'MessageId': '1'}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.delay())
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+def loadLF1(sqs, spillPath):
+    # LF1 gets its clients from awsClients, replace it before loading the handler.
+    stub = types.ModuleType('awsClients')
+    stub.getClient = lambda service: sqs
+    sys.modules['awsClients'] = stub
+    os.environ['SQS_SPILL_PATH'] = spillPath
+    spec = importlib.util.spec_from_file_location('lf1', LF1_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.print = lambda *args, **kwargs: None
+    return module
+
+def blocking(sqs, turn):
+    """What LF1 did before: one send_message inside the confirmation turn."""
+    sqs.send_message(QueueUrl='', MessageBody=json.dumps({'sessionid': f's{turn}'}))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the confirmation turn latency of a blocking send_message and of the LF1 producer, '
+                                                 'which sends a second copy of slow requests, with a stubbed SQS latency.')
+    parser.add_argument('--turns', type=int, default=300)
+    parser.add_argument('--median-ms', type=float, default=20)
+    parser.add_argument('--sigma', type=float, default=1.0)
+    args = parser.parse_args()
+
+    sqs = StubSqs(args.median_ms, args.sigma)
+    before = []
+    for turn in range(args.turns):
+        start = time.perf_counter()
+        blocking(sqs, turn)
+        before.append(time.perf_counter() - start)
+
+    spillPath = os.path.join(tempfile.mkdtemp(), 'spill.jsonl')
+    sqs = StubSqs(args.median_ms, args.sigma)
+    lf1 = loadLF1(sqs, spillPath)
+    after = []
+    outcomes = {}
+    for turn in range(args.turns):
+        start = time.perf_counter()
+        outcome = lf1.push_to_sqs('manhattan', 'indian', '19:00', '2', 'user@example.com', f's{turn}')
+        after.append(time.perf_counter() - start)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    # Send the requests still spilled, as the next confirmation would.
+    lf1.producer.wait(lf1.producer.drain_spill(), lf1.SQS_SEND_DEADLINE_SECONDS)
+
+    for name, latencies in (('Blocking send_message', before), ('Producer', after)):
+        print(f"{name:22s} p50 {percentile(latencies, 50) * 1000:6.1f} ms, p99 {percentile(latencies, 99) * 1000:6.1f} ms, "
+              f"max {max(latencies) * 1000:6.1f} ms")
+    print(f"Producer outcomes {outcomes}, second copy after {lf1.SQS_SEND_TIMEOUT_SECONDS * 1000:.0f} ms, "
+          f"{len(lf1.producer.sent)} requests acknowledged, spill left: {os.path.exists(spillPath)}")
@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+LF1_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'LF1 Lambda.py')
+
+def slot(value):
+    return {'shape': 'Scalar', 'value': {'originalValue': value, 'resolvedValues': [value], 'interpretedValue': value}}
+
+# A turn that only goes through slot validation and delegate, the most common one.
+VALIDATION_EVENT = {
+    'sessionId': 'bench',
+    'invocationSource': 'DialogCodeHook',
+    'inputTranscript': 'indian',
+    'interpretations': [{
+        'intent': {
+            'confirmationState': 'None',
+            'name': 'DiningSuggestionsIntent',
+            'slots': {
+                'Location': slot('manhattan'),
+                'Cuisine': slot('indian'),
+                'NumberOfPeople': None,
+                'DiningTime': None,
+                'email': None,
+            },
+        },
+    }],
+    'sessionState': {'sessionAttributes': {}},
+}
+
+# Runs in a fresh interpreter so that every measurement is a cold start.
+CHILD = '''
+import contextlib, importlib.util, io, json, sys, time
+t0 = time.perf_counter()
+spec = importlib.util.spec_from_file_location('lf1', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+t1 = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    module.lambda_handler(json.loads(sys.argv[2]))
+t2 = time.perf_counter()
+print(json.dumps({
+    'import_ms': (t1 - t0) * 1000,
+    'first_call_ms': (t2 - t1) * 1000,
+    'loaded': [m for m in ('boto3', 'botocore', 'dateutil') if m in sys.modules],
+}))
+'''
+
+def run(runs):
+    """
+    Starts LF1 in a new interpreter several times and reports the median
+    import time, first validation call and whole cold start (interpreter start included).
+    Args:
+        runs : int
+    Returns:
+        dict
+    """
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', CHILD, LF1_PATH, json.dumps(VALIDATION_EVENT)],
+                             check=True, capture_output=True, text=True).stdout
+        sample = json.loads(out.strip().splitlines()[-1])
+        sample['cold_start_ms'] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+    return {
+        'runs': runs,
+        'import_ms': statistics.median(s['import_ms'] for s in samples),
+        'first_call_ms': statistics.median(s['first_call_ms'] for s in samples),
+        'cold_start_ms': statistics.median(s['cold_start_ms'] for s in samples),
+        'loaded': samples[-1]['loaded'],
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures LF1 import time and cold start on the slot validation path.')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    result = run(args.runs)
+    print(f"LF1 import        : {result['import_ms']:.2f} ms")
+    print(f"First validation  : {result['first_call_ms']:.2f} ms")
+    print(f"Cold start total  : {result['cold_start_ms']:.2f} ms (median of {result['runs']} runs)")
+    print(f"Third party loaded: {', '.join(result['loaded']) or 'none'}")
@@ -0,0 +1,118 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+LF2_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'LF2 Lambda.py')
+
+class Latency:
+    """Log-normal latency model shared by the stubbed services."""
+    def __init__(self, median_ms, sigma, seed=0):
+        self.median = median_ms / 1000
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def draw(self):
+        with self.lock:
+            return self.median * self.random.lognormvariate(0, self.sigma)
+
+def hits(count):
+    return [{'_source': {'name': f'Restaurant {i}', 'address': f'{i} Broadway'}} for i in range(count)]
+
+class StubSearch:
+    """Stands in for OpenSearch and AsyncOpenSearch, msearch sleeps for the search latency."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.indices = types.SimpleNamespace(get_mapping=lambda index: {index: {'mappings': {'_meta': {'schema_version': 3}}}})
+
+    def msearch(self, body):
+        time.sleep(self.latency.draw())
+        return {'responses': [{'hits': {'hits': hits(5)}} for _ in body[::2]]}
+
+class StubAsyncSearch(StubSearch):
+    async def msearch(self, body):
+        await asyncio.sleep(self.latency.draw())
+        return {'responses': [{'hits': {'hits': hits(5)}} for _ in body[::2]]}
+
+class StubAws:
+    """Stands in for the DynamoDB and SES clients, the user-data table and the dedup table."""
+    def __init__(self, latency):
+        self.latency = latency
+
+    def put_item(self, **kwargs):
+        time.sleep(self.latency.draw())
+        return {}
+
+    update_item = delete_item = put_item
+
+    def send_raw_email(self, **kwargs):
+        time.sleep(self.latency.draw())
+        return {'MessageId': '1'}
+
+    def Table(self, name):
+        return self
+
+def loadLF2(aws, search, mode, concurrency):
+    stub = types.ModuleType('awsClients')
+    stub.getClient = lambda service: aws
+    stub.getResource = lambda service: aws
+    sys.modules['awsClients'] = stub
+    opensearch = types.ModuleType('opensearchpy')
+    opensearch.OpenSearch = lambda **kwargs: search
+    opensearch.AsyncOpenSearch = lambda **kwargs: StubAsyncSearch(search.latency)
+    sys.modules['opensearchpy'] = opensearch
+    sys.path.insert(0, os.path.dirname(LF2_PATH))
+    os.environ.update(WORKER_MODE=mode, ASYNC_CONCURRENCY=str(concurrency), SNAPSHOT_PATH='/nonexistent',
+                      TOPN_DIR='/nonexistent', SES_MAX_SEND_RATE='100000')
+    # Fresh modules, so that the second worker does not see the first one's requests as duplicates.
+    sys.modules.pop('emailDelivery', None)
+    sys.modules.pop('idempotency', None)
+    spec = importlib.util.spec_from_file_location('lf2', LF2_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.print = sys.modules['emailDelivery'].print = sys.modules['idempotency'].print = lambda *args, **kwargs: None
+    return module
+
+def buildEvent(count, cuisines):
+    return {'Records': [{
+        'messageId': str(i), 'receiptHandle': str(i),
+        'body': json.dumps({'sessionid': f's{i}', 'cuisine': cuisines[i % len(cuisines)], 'location': 'manhattan',
+                            'dining_time': '19:00', 'num_people': '2', 'email': f'user{i}@example.com'}),
+    } for i in range(count)]}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the sync and async LF2 workers on one SQS batch, with stubbed service latencies.')
+    parser.add_argument('--messages', type=int, default=10)
+    parser.add_argument('--median-ms', type=float, default=40, help='Median latency of every DynamoDB, OpenSearch and SES call.')
+    parser.add_argument('--sigma', type=float, default=0.5)
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+
+    event = buildEvent(args.messages, ['indian', 'greek', 'thai'])
+    times = {}
+    for mode in ('sync', 'async'):
+        latency = Latency(args.median_ms, args.sigma)
+        lf2 = loadLF2(StubAws(latency), StubSearch(latency), mode, args.concurrency)
+        # Warm invocation, the first one also creates the event loop and imports boto3.
+        lf2.lambda_handler(buildEvent(1, ['warmup']), None)
+        sends = lf2.emailStats['sends']
+        start = time.perf_counter()
+        response = lf2.lambda_handler(event, None)
+        times[mode] = time.perf_counter() - start
+        print(f"{mode:5s} {args.messages} messages in {times[mode] * 1000:7.1f} ms "
+              f"({times[mode] * 1000 / args.messages:.1f} ms per message), {len(response['batchItemFailures'])} failed, "
+              f"{lf2.emailStats['sends'] - sends} SES sends")
+        # SQS delivers the whole batch again, every message is recognized before any work.
+        sends = lf2.emailStats['sends']
+        start = time.perf_counter()
+        lf2.lambda_handler(event, None)
+        print(f"      redelivered in {(time.perf_counter() - start) * 1000:7.1f} ms, {lf2.emailStats['sends'] - sends} SES sends, "
+              f"{lf2.duplicateRate():.0%} of all messages were duplicates")
+    print(f"async is {times['sync'] / times['async']:.1f}x faster, one call takes about {args.median_ms:.0f} ms")
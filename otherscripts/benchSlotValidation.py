@@ -0,0 +1,86 @@
+import argparse
+import importlib.util
+import math
+import os
+import re
+import timeit
+
+LF1_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'LF1 Lambda.py')
+EMAILREGEX = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b'
+
+# Slot values seen on a typical conversation, valid and invalid ones.
+SAMPLES = [
+    ('manhattan', None, None, None, None),
+    ('Manhattan', 'Indian', None, None, None),
+    ('new york', 'indian', '4', None, None),
+    ('new york', 'indian', '4', '18:30', None),
+    ('new york', 'indian', '4', '18:30', 'someone@example.com'),
+    ('brooklyn', 'thai', '40', '23:00', 'not-an-email'),
+    ('manhattan', 'greek', '2', '9:00', None),
+]
+
+def loadLF1():
+    spec = importlib.util.spec_from_file_location('lf1', LF1_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def legacyValidate(location, cuisine, num_people, time, email):
+    """The validator LF1 used before the precompiled slot rules, kept for comparison."""
+    def build_validation_result(is_valid, violated_slot, message_content):
+        return {'isValid': is_valid, 'violatedSlot': violated_slot,
+                'message': {'contentType': 'PlainText', 'content': message_content}}
+
+    def parse_int(n):
+        try:
+            return int(n)
+        except ValueError:
+            return float('nan')
+
+    cuisines = ['italian', 'chinese', 'indian', 'greek', 'mexican', 'spanish','american','japanese']
+    locations = ['new york', 'manhattan']
+    if(location is None):
+        return build_validation_result(False, "Location", "This location is not supported.")
+    elif (location.lower() not in locations):
+        return build_validation_result(False, "Location", "This location is not supported.")
+    if cuisine is not None and cuisine.lower() not in cuisines:
+        return build_validation_result(False, 'Cuisine', 'Cuisine not available. Please try another.')
+    if num_people is not None:
+        num_people = int(num_people)
+        if num_people > 20 or num_people < 0:
+            return build_validation_result(False, 'NumberOfPeople', 'Maximum 20 people allowed. Try again')
+    if time is not None:
+        if len(time) != 5:
+            return build_validation_result(False, 'DiningTime', "Incorrect time entered. Please try again!")
+        hour, minute = time.split(':')
+        hour = parse_int(hour)
+        minute = parse_int(minute)
+        if math.isnan(hour) or math.isnan(minute):
+            return build_validation_result(False, 'DiningTime', 'Not a valid time')
+        if hour <= 10 or hour >= 21:
+            return build_validation_result(False, 'DiningTime', 'Our business hours are from 10 am to 9 pm. Can you please specify a time during this range?')
+    if email is not None:
+        if(not re.fullmatch(EMAILREGEX, email)):
+            build_validation_result(False, 'email', 'Can you please check your email address and try again?')
+    return build_validation_result(True, None, None)
+
+def bench(validate, number, samples=SAMPLES):
+    def runAll():
+        for sample in samples:
+            validate(*sample)
+    return min(timeit.repeat(runAll, number=number, repeat=5)) / (number * len(samples)) * 1e6
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compares the precompiled LF1 slot validator with the legacy one.')
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+    lf1 = loadLF1()
+    legacy = bench(legacyValidate, args.number)
+    current = bench(lf1.validate_dining_suggestion, args.number)
+    print(f"Legacy validator     : {legacy:.3f} us per call")
+    print(f"Precompiled validator: {current:.3f} us per call ({legacy / current:.2f}x)")
+    # Partially filled slots are most of the calls in a conversation, each sample is shown on its own.
+    for sample in SAMPLES:
+        legacy = bench(legacyValidate, args.number, [sample])
+        current = bench(lf1.validate_dining_suggestion, args.number, [sample])
+        print(f"  {str(sample):60} {legacy:.3f} us -> {current:.3f} us ({legacy / current:.2f}x)")
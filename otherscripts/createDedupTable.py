@@ -0,0 +1,33 @@
+import argparse
+import boto3
+
+TABLE_NAME = 'recommendation-requests'
+REGION = 'us-east-1'
+
+def createDedupTable(client, name):
+    """
+    Creates the table LF2 records its requests in (see lambdafunctions/idempotency.py),
+    with a TTL on expires_at so that done requests are deleted once forgotten.
+    Args:
+        client : boto3 DynamoDB client
+        name : string
+    """
+    if name not in client.list_tables()['TableNames']:
+        client.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': 'request_key', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'request_key', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        client.get_waiter('table_exists').wait(TableName=name)
+        print(f"Table {name} created")
+    ttl = client.describe_time_to_live(TableName=name)['TimeToLiveDescription']
+    if ttl.get('TimeToLiveStatus') not in ('ENABLED', 'ENABLING'):
+        client.update_time_to_live(TableName=name, TimeToLiveSpecification={'Enabled': True, 'AttributeName': 'expires_at'})
+        print(f"TTL enabled on {name}.expires_at")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Creates the DynamoDB table LF2 uses to recognize redelivered requests.')
+    parser.add_argument('--table', default=TABLE_NAME, help='Same as DEDUP_TABLE in LF2.')
+    args = parser.parse_args()
+    createDedupTable(boto3.client('dynamodb', region_name=REGION), args.table)
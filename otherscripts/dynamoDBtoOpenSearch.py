@@ -1,4 +1,13 @@
-import OpenSearch
+import argparse
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from decimal import Decimal
+import boto3
+from opensearchpy import OpenSearch, helpers
 from pprint import pprint
 
 HOST = 'search-cloud-hw-1-43gl3ui4fy5t6aqdiv2ddgoo7a.aos.us-east-1.on.aws' # cluster endpoint, for example: my-test-domain.us-east-1.es.amazonaws.com
@@ -8,6 +17,9 @@ SERVICE = 'aos'
 # auth = AWSV4SignerAuth(credentials, region, service)
 AUTH = ('cloud', 'Cloud-hw1') 
 INDEX = 'restaurant-index'
+TABLE_NAME = 'yelp-restaurants'
+# Bump whenever the settings or mappings below change, LF2 checks it before searching.
+SCHEMA_VERSION = 3
 
 def createClient():
     client = OpenSearch(
@@ -21,20 +33,306 @@ def createClient():
     )
     return client
 
-def createIndex(client):
-    
-    index_name = INDEX
-    index_body = {
+def indexBody():
+    """
+    Settings and mappings of the index. Cuisine and zip code are keywords so
+    recommendations can filter on them without scoring, and segments are kept
+    sorted by rating so a top-k query sorted the same way can stop early.
+    """
+    return {
         'settings': {
             'index': {
-            'number_of_shards': 4
+                # The whole catalog is at most a few MB, far below what one shard handles well.
+                'number_of_shards': 1,
+                'sort.field': 'rating',
+                'sort.order': 'desc'
+            }
+        },
+        'mappings': {
+            '_meta': {
+                'schema_version': SCHEMA_VERSION
+            },
+            'properties': {
+                'id': {'type': 'keyword'},
+                'alias': {'type': 'keyword'},
+                'cuisine': {'type': 'keyword'},
+                'phone': {'type': 'keyword'},
+                'image_url': {'type': 'keyword', 'index': False},
+                'name': {'type': 'text', 'fields': {'raw': {'type': 'keyword'}}},
+                'rating': {'type': 'float'},
+                'review_count': {'type': 'integer'},
+                'yelp_url': {'type': 'keyword', 'index': False},
+                'insertedAtTimestamp': {'type': 'date'},
+                'latitude': {'type': 'float'},
+                'longitude': {'type': 'float'},
+                'coordinates': {'type': 'geo_point'},
+                'address': {'type': 'text'},
+                'state': {'type': 'keyword'},
+                'zip_code': {'type': 'keyword'},
+                # One opening hours bitmap per weekday, only read back from _source.
+                'hours': {'type': 'long', 'index': False, 'doc_values': False},
+                'price_level': {'type': 'byte'}
             }
         }
     }
+
+def schemaVersion(client):
+    """
+    Returns:
+        int : the schema version stored in the index, 0 for an unmanaged index,
+              None when the index does not exist
+    """
+    if not client.indices.exists(index=INDEX):
+        return None
+    mappings = next(iter(client.indices.get_mapping(index=INDEX).values()))['mappings']
+    return mappings.get('_meta', {}).get('schema_version', 0)
+
+def createIndex(client):
+    """
+    Creates the index with the managed settings and mappings.
+    Returns:
+        bool : False when the index already existed
+    """
+    if client.indices.exists(index=INDEX):
+        return False
+    client.indices.create(index=INDEX, body=indexBody())
+    print(f"Index {INDEX} created")
+    return True
+
+def upgradeIndex(client, version):
+    """
+    Brings an index of an older schema up to date in place when the newer
+    schema only adds fields, which put_mapping accepts.
+    Returns:
+        bool : False when the index has to be recreated instead
+    """
+    # Version 3 added the opening hours and price level to version 2.
+    if version != 2:
+        return False
+    mappings = indexBody()['mappings']
+    meta = next(iter(client.indices.get_mapping(index=INDEX).values()))['mappings'].get('_meta', {})
+    meta['schema_version'] = SCHEMA_VERSION
+    client.indices.put_mapping(index=INDEX, body={'properties': mappings['properties'], '_meta': meta})
+    print(f"{INDEX} upgraded from schema version {version} to {SCHEMA_VERSION}")
+    return True
+
+def writeIndexVersion(client, version=None):
+    """
+    Stamps the index with a new version marker in its mapping metadata.
+    LF2 drops its cached recommendations when it sees the marker change,
+    so run this after every reindex.
+    Args:
+        client : OpenSearch
+        version : string, defaults to the current timestamp
+    Returns:
+        string
+    """
+    version = version or datetime.datetime.now().isoformat()
+    mappings = next(iter(client.indices.get_mapping(index=INDEX).values()))['mappings']
+    # _meta is replaced as a whole, so keep whatever else is stored in it.
+    meta = mappings.get('_meta', {})
+    meta['index_version'] = version
+    client.indices.put_mapping(index=INDEX, body={'_meta': meta})
+    return version
+
+def scanSegment(segment, totalSegments, items):
+    """Scans one segment of the table, page by page, into the items queue."""
+    # Resources are not thread safe, so every segment gets its own.
+    table = boto3.session.Session().resource('dynamodb', region_name=REGION).Table(TABLE_NAME)
+    kwargs = {'Segment': segment, 'TotalSegments': totalSegments}
+    while True:
+        response = table.scan(**kwargs)
+        for item in response['Items']:
+            items.put(item)
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def scanTable(totalSegments):
+    """
+    Yields every item of the restaurants table, read by a parallel Scan
+    with one thread per segment.
+    Args:
+        totalSegments : int
+    """
+    items = queue.Queue(maxsize=1000)
+    finished = object()
+    errors = []
+
+    def worker(segment):
+        try:
+            scanSegment(segment, totalSegments, items)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(finished)
+
+    for segment in range(totalSegments):
+        threading.Thread(target=worker, args=(segment,), daemon=True).start()
+    remaining = totalSegments
+    while remaining:
+        item = items.get()
+        if item is finished:
+            remaining -= 1
+        else:
+            yield item
+    if errors:
+        raise errors[0]
+
+def plainNumber(value):
+    # DynamoDB numbers come back as Decimal, which the JSON serializer turns into floats.
+    # Nested ones too, the hours bitmaps have to stay integers.
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, list):
+        return [plainNumber(entry) for entry in value]
+    if isinstance(value, dict):
+        return {key: plainNumber(entry) for key, entry in value.items()}
+    return value
+
+def toDocument(item):
+    doc = {key: plainNumber(value) for key, value in item.items()}
+    if doc.get('latitude') is not None and doc.get('longitude') is not None:
+        doc['coordinates'] = {'lat': doc['latitude'], 'lon': doc['longitude']}
+    return doc
+
+def toActions(items):
+    for item in items:
+        yield {
+            '_index': INDEX,
+            '_id': f"{item['id']}-{item['cuisine']}",
+            '_source': toDocument(item),
+        }
+
+def prepareForBulkLoad(client, dropReplicas=False):
+    """
+    Turns off refresh for the duration of a bulk load, and replicas too when dropReplicas is set.
+    Only drop them for an index that is not serving yet: without replicas one node
+    failure during the load loses shards.
+    Returns:
+        dict : the previous settings, to hand to restoreSettings
+    """
+    current = next(iter(client.indices.get_settings(index=INDEX).values()))['settings']['index']
+    previous = {'refresh_interval': current.get('refresh_interval')}
+    settings = {'refresh_interval': '-1'}
+    if dropReplicas:
+        previous['number_of_replicas'] = current.get('number_of_replicas')
+        settings['number_of_replicas'] = 0
+    client.indices.put_settings(index=INDEX, body={'index': settings})
+    return previous
+
+def restoreSettings(client, previous):
+    # A None value puts the setting back to its default.
+    client.indices.put_settings(index=INDEX, body={'index': previous})
+    client.indices.refresh(index=INDEX)
+
+def syncTable(client, segments=4, threads=4, chunkSize=500, maxChunkBytes=5 * 1024 * 1024, maxInflightBytes=40 * 1024 * 1024,
+              items=None, fresh=False):
+    """
+    Streams the whole restaurants table into the index with parallel_bulk.
+    At most about maxInflightBytes of documents are buffered or being sent at once.
+    The items are read with a parallel Scan unless given, for example from a catalog export.
+    Replicas are only turned off while loading a fresh index, a live one keeps them.
+    Returns:
+        dict : documents indexed, failed and the indexing rate
+    """
+    queueSize = max(1, maxInflightBytes // maxChunkBytes - threads)
+    start = time.monotonic()
+    indexed = failed = 0
+    previous = prepareForBulkLoad(client, dropReplicas=fresh)
     try:
-        response = client.indices.create(index_name, body=index_body)
-        print("Index Creation Failed")
+        for ok, info in helpers.parallel_bulk(client, toActions(scanTable(segments) if items is None else items),
+                                              thread_count=threads, chunk_size=chunkSize,
+                                              max_chunk_bytes=maxChunkBytes, queue_size=queueSize,
+                                              raise_on_error=False, raise_on_exception=False):
+            if ok:
+                indexed += 1
+            else:
+                failed += 1
+                print(f"Could not index : {info}")
+    finally:
+        restoreSettings(client, previous)
+    elapsed = time.monotonic() - start
+    return {'indexed': indexed, 'failed': failed, 'seconds': elapsed, 'docs_per_second': indexed / elapsed if elapsed else 0}
+
+def readChangeLog(path):
+    """
+    Reads the change log written by yelpToDynamoDB.py.
+    Returns:
+        list : the distinct (id, cuisine) keys it mentions
+    """
+    keys = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                change = json.loads(line)
+                keys[(change['id'], change['cuisine'])] = True
+    return list(keys)
+
+def fetchItems(keys):
+    """Yields the current items for the given keys, read with BatchGetItem 100 keys at a time."""
+    dynamodb = boto3.resource('dynamodb', region_name=REGION)
+    for start in range(0, len(keys), 100):
+        request = {TABLE_NAME: {'Keys': [{'id': id, 'cuisine': cuisine} for id, cuisine in keys[start:start + 100]]}}
+        delay = 0.05
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            yield from response['Responses'].get(TABLE_NAME, [])
+            request = response.get('UnprocessedKeys')
+            if request:
+                time.sleep(delay)
+                delay = min(delay * 2, 2)
+
+def syncChanges(client, changeLogPath, threads=4, chunkSize=500):
+    """
+    Reindexes only the records listed in a change log, then removes the log.
+    Returns:
+        dict : documents indexed and failed
+    """
+    keys = readChangeLog(changeLogPath)
+    indexed = failed = 0
+    for ok, info in helpers.parallel_bulk(client, toActions(fetchItems(keys)), thread_count=threads,
+                                          chunk_size=chunkSize, raise_on_error=False, raise_on_exception=False):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+            print(f"Could not index : {info}")
+    if not failed:
+        os.remove(changeLogPath)
+    return {'indexed': indexed, 'failed': failed}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Indexes the yelp-restaurants table into OpenSearch.')
+    parser.add_argument('--segments', type=int, default=4, help='Parallel Scan segments.')
+    parser.add_argument('--threads', type=int, default=4, help='Concurrent bulk requests.')
+    parser.add_argument('--chunk-size', type=int, default=500, help='Documents per bulk request.')
+    parser.add_argument('--max-chunk-mb', type=float, default=5, help='Largest bulk request.')
+    parser.add_argument('--max-inflight-mb', type=float, default=40, help='Most document bytes buffered or being sent.')
+    parser.add_argument('--version-only', action='store_true', help='Only write a new index version marker.')
+    parser.add_argument('--recreate', action='store_true', help='Drop and recreate an index built with an older schema.')
+    parser.add_argument('--from-catalog', help='Read the restaurants from this exportCatalog.py export instead of scanning the table.')
+    parser.add_argument('--change-log', help='Only reindex the records in this change log from yelpToDynamoDB.py.')
+    args = parser.parse_args()
 
-    except Exception as e:
-        print(f"An exception occured : {e}")
-    
\ No newline at end of file
+    client = createClient()
+    if args.change_log:
+        report = syncChanges(client, args.change_log, args.threads, args.chunk_size)
+        print(f"Reindexed {report['indexed']} changed documents ({report['failed']} failed)")
+    elif not args.version_only:
+        version = schemaVersion(client)
+        if version is not None and version != SCHEMA_VERSION and not upgradeIndex(client, version):
+            if not args.recreate:
+                raise SystemExit(f"{INDEX} has schema version {version}, expected {SCHEMA_VERSION}. Run again with --recreate.")
+            client.indices.delete(index=INDEX)
+        items = None
+        if args.from_catalog:
+            # Only needed for catalog exports, which pull in pyarrow.
+            from exportCatalog import catalogItems
+            items = catalogItems(args.from_catalog)
+        created = createIndex(client)
+        report = syncTable(client, args.segments, args.threads, args.chunk_size,
+                           int(args.max_chunk_mb * 1024 * 1024), int(args.max_inflight_mb * 1024 * 1024), items, created)
+        print(f"Indexed {report['indexed']} documents ({report['failed']} failed) in {report['seconds']:.1f}s, "
+              f"{report['docs_per_second']:.0f} docs/sec")
+    print(f"Index version set to {writeIndexVersion(client)}")
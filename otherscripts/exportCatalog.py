@@ -0,0 +1,122 @@
+import argparse
+import os
+import shutil
+import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs
+from dynamoDBtoOpenSearch import scanTable, toDocument
+
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'catalog')
+# Arrow IPC files are uncompressed and memory mapped when read, Parquet is smaller but decoded on read.
+FORMATS = ('arrow', 'parquet')
+# Rows converted at a time, so the scan never has to fit in memory.
+BATCH_ROWS = 10000
+
+SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('alias', pa.string()),
+    ('cuisine', pa.string()),
+    ('name', pa.string()),
+    ('phone', pa.string()),
+    ('image_url', pa.string()),
+    ('yelp_url', pa.string()),
+    ('address', pa.string()),
+    ('state', pa.string()),
+    ('zip_code', pa.string()),
+    # float64, so that a rating read back into OpenSearch or a card stays 4.3 and not 4.300000190734863.
+    ('rating', pa.float64()),
+    ('review_count', pa.int32()),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+    ('price_level', pa.uint8()),
+    # Opening hours bitmaps, Monday first, see hoursBitmap in yelpToDynamoDB.py.
+    ('hours', pa.list_(pa.uint64(), 7)),
+    ('insertedAtTimestamp', pa.string()),
+    ('content_hash', pa.string()),
+])
+
+def fileFormat(format):
+    return ds.IpcFileFormat() if format == 'arrow' else ds.ParquetFileFormat()
+
+def toBatches(items):
+    """Converts DynamoDB items into record batches of the catalog schema, BATCH_ROWS rows at a time."""
+    rows = []
+    for item in items:
+        rows.append(toDocument(item))
+        if len(rows) == BATCH_ROWS:
+            yield pa.RecordBatch.from_pylist(rows, schema=SCHEMA)
+            rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=SCHEMA)
+
+def writeCatalog(path, items, format='arrow'):
+    """
+    Streams items into a catalog directory with one partition per cuisine
+    (cuisine=<name>/part-0.<format>). The new catalog is written next to the
+    old one and swapped in once complete, so readers never see a partial export.
+    Args:
+        path : string
+        items : iterable of DynamoDB items
+        format : 'arrow' or 'parquet'
+    Returns:
+        int : the number of rows written
+    """
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    counted = {'rows': 0}
+
+    def batches():
+        for batch in toBatches(items):
+            counted['rows'] += batch.num_rows
+            yield batch
+
+    ds.write_dataset(batches(), tmp, schema=SCHEMA, format=fileFormat(format),
+                     partitioning=ds.partitioning(pa.schema([('cuisine', pa.string())]), flavor='hive'),
+                     basename_template='part-{i}.' + format)
+    old = path + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return counted['rows']
+
+def catalogFormat(path):
+    """Tells the format of a catalog from its files."""
+    for root, _, files in os.walk(path):
+        for name in files:
+            extension = name.rsplit('.', 1)[-1]
+            if extension in FORMATS:
+                return extension
+    raise ValueError(f"{path} holds no catalog files")
+
+def openCatalog(path):
+    """
+    Opens a catalog as an Arrow dataset, memory mapping Arrow IPC files.
+    Filter on the cuisine partition to only read the files of that cuisine, for example
+    openCatalog(path).to_table(filter=ds.field('cuisine') == 'indian').
+    """
+    return ds.dataset(path, format=fileFormat(catalogFormat(path)),
+                      filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+                      partitioning=ds.partitioning(pa.schema([('cuisine', pa.string())]), flavor='hive'))
+
+def catalogItems(path):
+    """
+    Yields every restaurant of a catalog as a dict shaped like a DynamoDB
+    item, without the attributes it does not have, but with plain numbers.
+    """
+    for batch in openCatalog(path).to_batches():
+        for row in batch.to_pylist():
+            yield {key: value for key, value in row.items() if value is not None}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exports yelp-restaurants to a columnar catalog partitioned by cuisine.')
+    parser.add_argument('--output', default=OUTPUT)
+    parser.add_argument('--format', choices=FORMATS, default='arrow')
+    parser.add_argument('--segments', type=int, default=4, help='Parallel Scan segments.')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    count = writeCatalog(args.output, scanTable(args.segments), args.format)
+    print(f"Wrote {count} restaurants to {args.output} in {time.monotonic() - start:.1f}s")
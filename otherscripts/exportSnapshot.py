@@ -0,0 +1,144 @@
+import argparse
+import json
+import math
+import os
+import time
+import numpy as np
+from dynamoDBtoOpenSearch import scanTable, toDocument
+
+OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'restaurants.snapshot')
+MAGIC = b'RSNAP1\n'
+ALIGNMENT = 64
+# Text columns, stored back to back in one packed byte table.
+STRING_FIELDS = ['id', 'name', 'address', 'image_url', 'yelp_url', 'phone']
+# Side of a geo grid cell, about 550 m of latitude.
+GEO_CELL_DEGREES = 0.005
+# Keeps cell coordinates positive so that they pack into one sortable integer.
+GEO_CELL_OFFSET = 1 << 17
+# Cell of the restaurants without coordinates, sorts after every real cell.
+NO_CELL = (1 << 62)
+# Opening hours of a restaurant whose details were never fetched, so that it is never filtered out.
+SLOTS_PER_DAY = 48
+ALWAYS_OPEN = (1 << SLOTS_PER_DAY) - 1
+
+def geoCell(latitude, longitude):
+    """Packs the grid cell of a point so that sorting by it groups rows by latitude band, then longitude."""
+    if latitude is None or longitude is None:
+        return NO_CELL
+    row = math.floor(latitude / GEO_CELL_DEGREES) + GEO_CELL_OFFSET
+    column = math.floor(longitude / GEO_CELL_DEGREES) + GEO_CELL_OFFSET
+    return (row << 18) | column
+
+def buildColumns(docs):
+    """
+    Turns restaurant documents into the snapshot columns. Rows are grouped by
+    cuisine so that every cuisine is one contiguous range, and sorted by geo
+    grid cell within it so that LF2 finds the rows near a point with a binary search.
+    Args:
+        docs : list of dict
+    Returns:
+        (dict, dict) : the arrays by column name and the header metadata
+    """
+    for doc in docs:
+        doc['geo_cell'] = geoCell(doc.get('latitude'), doc.get('longitude'))
+    docs = sorted(docs, key=lambda doc: (doc['cuisine'], doc['geo_cell'], doc['id']))
+    cuisines = sorted({doc['cuisine'] for doc in docs})
+    codes = {cuisine: code for code, cuisine in enumerate(cuisines)}
+    ranges = {}
+    for row, doc in enumerate(docs):
+        start, _ = ranges.get(doc['cuisine'], (row, row))
+        ranges[doc['cuisine']] = (start, row + 1)
+
+    strings = bytearray()
+    offsets = [0]
+    for doc in docs:
+        for field in STRING_FIELDS:
+            strings += (doc.get(field) or '').encode('utf8')
+            offsets.append(len(strings))
+
+    def number(doc, field):
+        value = doc.get(field)
+        return float('nan') if value is None else value
+
+    columns = {
+        'rating': np.array([number(doc, 'rating') for doc in docs], dtype='<f4'),
+        'review_count': np.array([doc.get('review_count') or 0 for doc in docs], dtype='<i4'),
+        'latitude': np.array([number(doc, 'latitude') for doc in docs], dtype='<f4'),
+        'longitude': np.array([number(doc, 'longitude') for doc in docs], dtype='<f4'),
+        'cuisine': np.array([codes[doc['cuisine']] for doc in docs], dtype='u1'),
+        'zip_code': np.array([int(doc['zip_code']) if (doc.get('zip_code') or '').isdigit() else 0 for doc in docs], dtype='<i4'),
+        'geo_cell': np.array([doc['geo_cell'] for doc in docs], dtype='<i8'),
+        # One row of 7 half-hour bitmaps per restaurant, Monday first.
+        'hours': np.array([doc.get('hours') or [ALWAYS_OPEN] * 7 for doc in docs], dtype='<u8').reshape(len(docs), 7),
+        'price_level': np.array([doc.get('price_level') or 0 for doc in docs], dtype='u1'),
+        'string_offsets': np.array(offsets, dtype='<u4'),
+        'strings': np.frombuffer(bytes(strings), dtype='u1'),
+    }
+    header = {
+        'count': len(docs),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'cuisines': cuisines,
+        'cuisine_ranges': ranges,
+        'string_fields': STRING_FIELDS,
+        'geo_cell_degrees': GEO_CELL_DEGREES,
+        'geo_cell_offset': GEO_CELL_OFFSET,
+        'slots_per_day': SLOTS_PER_DAY,
+        'zip_centroids': zipCentroids(docs),
+    }
+    return columns, header
+
+def zipCentroids(docs):
+    """Average position of the restaurants of every zip code, used to locate a user who gives a zip."""
+    points = {}
+    for doc in docs:
+        if doc.get('zip_code') and doc.get('latitude') is not None and doc.get('longitude') is not None:
+            points.setdefault(doc['zip_code'], []).append((doc['latitude'], doc['longitude']))
+    return {
+        zipCode: [sum(p[0] for p in found) / len(found), sum(p[1] for p in found) / len(found)]
+        for zipCode, found in points.items()
+    }
+
+def writeSnapshot(path, columns, header):
+    """
+    Writes the columns to one file that LF2 memory maps: a magic string, the
+    length of a JSON header, the header, then every array at an aligned offset.
+    """
+    def align(n):
+        return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+    # The header holds the array offsets, which depend on the header size, so size it first.
+    header['columns'] = {name: {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': 0}
+                         for name, array in columns.items()}
+    prefix = len(MAGIC) + 8
+    offset = align(prefix + len(json.dumps(header)) + 32 * len(columns))
+    for name, array in columns.items():
+        header['columns'][name]['offset'] = offset
+        offset = align(offset + array.nbytes)
+    encoded = json.dumps(header).encode('utf8')
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(encoded).to_bytes(8, 'little'))
+        f.write(encoded)
+        for name, array in columns.items():
+            f.write(b'\0' * (header['columns'][name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+    os.replace(tmp, path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Exports yelp-restaurants to the columnar snapshot LF2 ships with.')
+    parser.add_argument('--output', default=OUTPUT)
+    parser.add_argument('--segments', type=int, default=4, help='Parallel Scan segments.')
+    parser.add_argument('--from-catalog', help='Read the restaurants from this exportCatalog.py export instead of scanning the table.')
+    args = parser.parse_args()
+
+    if args.from_catalog:
+        from exportCatalog import catalogItems
+        items = catalogItems(args.from_catalog)
+    else:
+        items = scanTable(args.segments)
+    docs = [toDocument(item) for item in items]
+    columns, header = buildColumns(docs)
+    writeSnapshot(args.output, columns, header)
+    print(f"Wrote {header['count']} restaurants to {args.output} ({os.path.getsize(args.output) / 1024:.0f} KB)")
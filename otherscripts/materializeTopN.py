@@ -0,0 +1,217 @@
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from urllib.parse import quote, unquote
+import boto3
+from dynamoDBtoOpenSearch import REGION, scanTable, toDocument
+from exportSnapshot import ALWAYS_OPEN, buildColumns, writeSnapshot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions'))
+import restaurantSnapshot as ranking
+
+VIEW_TABLE = 'restaurant-topn'
+VIEW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdafunctions', 'topn')
+MANIFEST_FILE = 'topNManifest.json'
+# Candidates kept per list, so LF2 still has RESULT_SIZE left once the closed restaurants are dropped.
+TOP_N = 25
+# Fields LF2 needs to email or show a recommendation, the rest of the record stays out of the view.
+VIEW_FIELDS = ['id', 'name', 'address', 'rating', 'review_count', 'image_url', 'yelp_url', 'zip_code',
+               'price_level', 'hours', 'distance_km']
+
+def viewKey(cuisine, location):
+    # An empty location holds the lists for a location LF2 cannot place.
+    return f"{cuisine}|{location}"
+
+def compact(hit):
+    entry = {field: hit['_source'][field] for field in VIEW_FIELDS if hit['_source'].get(field) not in (None, '')}
+    # Unknown hours are stored as always open in the snapshot, LF2 treats missing hours the same way.
+    if entry.get('hours') == [ALWAYS_OPEN] * 7:
+        del entry['hours']
+    return entry
+
+def rankVariants(snap, cuisine, location):
+    """
+    The top TOP_N of one cuisine for one location, in every ranking LF2 can be set to.
+    Returns:
+        dict : 'rating', 'geo' (rating blended with distance) and 'nearest' lists
+    """
+    variants = {
+        'rating': [compact(hit) for hit in ranking.snapshotTopK(snap, cuisine, TOP_N)],
+        'geo': [compact(hit) for hit in ranking.snapshotNearby(snap, cuisine, location, TOP_N)],
+    }
+    point = ranking.locatePoint(snap, location)
+    if point is not None:
+        nearest = []
+        for row, distance in ranking.snapshotNearest(snap, cuisine, point[0], point[1], TOP_N):
+            hit = ranking.snapshotHit(snap, row)
+            hit['_source']['distance_km'] = round(distance, 2)
+            nearest.append(compact(hit))
+        variants['nearest'] = nearest
+    return variants
+
+def locations(header):
+    """Every location a view is kept for: the unplaceable one, the named ones and every zip code with restaurants."""
+    return [''] + sorted(ranking.LOCATION_CENTROIDS) + sorted(header['zip_centroids'])
+
+def cuisineDigests(docs, places):
+    """
+    Hash of what the views of each cuisine depend on: its restaurants, the
+    locations and the ranking settings. A cuisine whose digest did not change
+    keeps its views.
+    """
+    settings = json.dumps([places, TOP_N, ranking.GEO_DISTANCE_WEIGHT])
+    byCuisine = {}
+    for doc in docs:
+        content = doc.get('content_hash') or json.dumps(doc, sort_keys=True, default=str)
+        byCuisine.setdefault(doc['cuisine'], []).append(f"{doc['id']}:{content}:{doc.get('hours')}")
+    return {
+        cuisine: hashlib.sha256('\n'.join(sorted(entries) + [settings]).encode('utf8')).hexdigest()[:32]
+        for cuisine, entries in byCuisine.items()
+    }
+
+def loadManifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def saveManifest(path, manifest):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+def createViewTable(dynamodb):
+    client = dynamodb.meta.client
+    if VIEW_TABLE in client.list_tables()['TableNames']:
+        return
+    client.create_table(
+        TableName=VIEW_TABLE,
+        KeySchema=[{'AttributeName': 'view_key', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'view_key', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    client.get_waiter('table_exists').wait(TableName=VIEW_TABLE)
+    print(f"Table {VIEW_TABLE} created")
+
+def writeToTable(dynamodb, views):
+    """One item per (cuisine, location), its lists stored as one JSON string so the item stays compact."""
+    with dynamodb.Table(VIEW_TABLE).batch_writer(overwrite_by_pkeys=['view_key']) as writer:
+        for view in views:
+            writer.put_item(Item={
+                'view_key': view['view_key'],
+                'digest': view['digest'],
+                'updated_at': view['updated_at'],
+                'variants': json.dumps(view['variants'], separators=(',', ':')),
+            })
+
+def tableKeys(dynamodb):
+    """Every view key stored in the views table."""
+    table = dynamodb.Table(VIEW_TABLE)
+    keys = []
+    kwargs = {'ProjectionExpression': 'view_key'}
+    while True:
+        response = table.scan(**kwargs)
+        keys += [item['view_key'] for item in response['Items']]
+        if 'LastEvaluatedKey' not in response:
+            return keys
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def deleteFromTable(dynamodb, keys):
+    with dynamodb.Table(VIEW_TABLE).batch_writer() as writer:
+        for key in keys:
+            writer.delete_item(Key={'view_key': key})
+
+def viewPath(directory, key):
+    return os.path.join(directory, quote(key, safe='') + '.json.gz')
+
+def writeToDirectory(directory, views):
+    """One gzipped JSON file per (cuisine, location), which LF2 reads instead of a GetItem."""
+    os.makedirs(directory, exist_ok=True)
+    for view in views:
+        path = viewPath(directory, view['view_key'])
+        with gzip.open(path + '.tmp', 'wt', encoding='utf8') as f:
+            json.dump(view, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+def directoryKeys(directory):
+    """Every view key with a file in the directory."""
+    if not os.path.isdir(directory):
+        return []
+    suffix = '.json.gz'
+    return [unquote(name[:-len(suffix)]) for name in os.listdir(directory) if name.endswith(suffix)]
+
+def deleteFromDirectory(directory, keys):
+    for key in keys:
+        os.remove(viewPath(directory, key))
+
+def materialize(docs, manifest, full=False):
+    """
+    Ranks the views of every cuisine whose digest changed since the manifest.
+    Args:
+        docs : list of restaurant documents
+        manifest : dict, cuisine -> digest of its views already written
+        full : bool, rank every cuisine whatever the manifest says
+    Returns:
+        (list, dict, set) : the views to write, the updated manifest and the key of
+                            every view the restaurants have now, any other stored view is stale
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'materialize.snapshot')
+    columns, header = buildColumns(docs)
+    writeSnapshot(path, columns, header)
+    snap = ranking.loadSnapshot(path)
+    places = locations(header)
+    digests = cuisineDigests(docs, places)
+    now = datetime.datetime.now().isoformat()
+
+    views = []
+    # Cuisines that are gone are forgotten, their views are deleted as stale.
+    updated = {cuisine: digest for cuisine, digest in manifest.items() if cuisine in digests}
+    for cuisine, digest in sorted(digests.items()):
+        if not full and manifest.get(cuisine) == digest:
+            continue
+        for location in places:
+            views.append({'view_key': viewKey(cuisine, location), 'cuisine': cuisine, 'location': location,
+                          'digest': digest, 'updated_at': now, 'variants': rankVariants(snap, cuisine, location)})
+        updated[cuisine] = digest
+    os.remove(path)
+    os.rmdir(directory)
+    return views, updated, {viewKey(cuisine, location) for cuisine in digests for location in places}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Precomputes the top restaurants of every cuisine and location for LF2.')
+    parser.add_argument('--segments', type=int, default=4, help='Parallel Scan segments.')
+    parser.add_argument('--from-catalog', help='Read the restaurants from this exportCatalog.py export instead of scanning the table.')
+    parser.add_argument('--output-dir', help=f'Write one file per view to this directory (for example {VIEW_DIR}) instead of the {VIEW_TABLE} table.')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='Digests of the cuisines already materialized.')
+    parser.add_argument('--full', action='store_true', help='Rank every cuisine again.')
+    args = parser.parse_args()
+
+    if args.from_catalog:
+        from exportCatalog import catalogItems
+        items = catalogItems(args.from_catalog)
+    else:
+        items = scanTable(args.segments)
+    docs = [toDocument(item) for item in items]
+
+    views, manifest, keys = materialize(docs, loadManifest(args.manifest), args.full)
+    # Views of a zip code or a cuisine that left the catalog would otherwise keep being served.
+    if args.output_dir:
+        writeToDirectory(args.output_dir, views)
+        stale = sorted(set(directoryKeys(args.output_dir)) - keys)
+        deleteFromDirectory(args.output_dir, stale)
+    else:
+        dynamodb = boto3.resource('dynamodb', region_name=REGION)
+        createViewTable(dynamodb)
+        writeToTable(dynamodb, views)
+        stale = sorted(set(tableKeys(dynamodb)) - keys)
+        deleteFromTable(dynamodb, stale)
+    saveManifest(args.manifest, manifest)
+    print(f"Wrote {len(views)} views for {len({view['cuisine'] for view in views})} changed cuisines, "
+          f"deleted {len(stale)} stale views")
@@ -0,0 +1,93 @@
+import argparse
+import json
+import boto3
+
+REGION = 'us-east-1'
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/905418445552/dining-suggestion-queue'
+# Attributes LF2 adds when it dead letters a message, not sent back with the replay.
+DEAD_LETTER_ATTRIBUTES = ('SourceQueueUrl', 'ReceiveCount')
+
+def receiveDeadLetters(sqs, dlqUrl, limit):
+    """Receives up to limit messages from the dead letter queue, they stay hidden while they are replayed."""
+    messages = []
+    while len(messages) < limit:
+        response = sqs.receive_message(
+            QueueUrl=dlqUrl,
+            MessageAttributeNames=['All'],
+            MaxNumberOfMessages=min(10, limit - len(messages)),
+            WaitTimeSeconds=1,
+        )
+        received = response.get('Messages', [])
+        if not received:
+            break
+        messages.extend(received)
+    return messages
+
+def replay(sqs, dlqUrl, messages, queueUrl=None):
+    """
+    Sends dead lettered messages back to the queue they came from, with their
+    original attributes (so LF2 still recognizes them by IdempotencyKey), and
+    deletes them from the dead letter queue once the queue has them.
+    Args:
+        sqs : boto3 SQS client
+        dlqUrl : string
+        messages : list of received messages
+        queueUrl : string, replay every message to this queue instead of its source queue
+    Returns:
+        int : the number of messages replayed
+    """
+    byQueue = {}
+    for message in messages:
+        attributes = message.get('MessageAttributes', {})
+        source = queueUrl or attributes.get('SourceQueueUrl', {}).get('StringValue') or QUEUE_URL
+        byQueue.setdefault(source, []).append(message)
+
+    replayed = 0
+    for source, queued in byQueue.items():
+        for start in range(0, len(queued), 10):
+            chunk = queued[start:start + 10]
+            response = sqs.send_message_batch(
+                QueueUrl=source,
+                Entries=[{
+                    'Id': str(i),
+                    'MessageBody': message['Body'],
+                    'MessageAttributes': {
+                        name: {'DataType': value['DataType'], 'StringValue': value['StringValue']}
+                        for name, value in message.get('MessageAttributes', {}).items()
+                        if name not in DEAD_LETTER_ATTRIBUTES and 'StringValue' in value
+                    },
+                } for i, message in enumerate(chunk)],
+            )
+            sent = [chunk[int(success['Id'])] for success in response.get('Successful', [])]
+            for failure in response.get('Failed', []):
+                print(f"Could not replay message {chunk[int(failure['Id'])]['MessageId']} : {failure.get('Message')}")
+            if sent:
+                sqs.delete_message_batch(
+                    QueueUrl=dlqUrl,
+                    Entries=[{'Id': str(i), 'ReceiptHandle': message['ReceiptHandle']} for i, message in enumerate(sent)],
+                )
+            replayed += len(sent)
+    return replayed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replays the requests LF2 moved to its dead letter queue.')
+    parser.add_argument('--dlq-url', required=True, help='Same as DLQ_URL in LF2.')
+    parser.add_argument('--queue-url', help='Replay to this queue instead of the queue each message came from.')
+    parser.add_argument('--max', type=int, default=100, help='Most messages replayed.')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the messages, they come back to the dead letter queue.')
+    args = parser.parse_args()
+
+    sqs = boto3.client('sqs', region_name=REGION)
+    messages = receiveDeadLetters(sqs, args.dlq_url, args.max)
+    if args.dry_run:
+        for message in messages:
+            attributes = message.get('MessageAttributes', {})
+            print(json.dumps({
+                'messageId': message['MessageId'],
+                'receives': attributes.get('ReceiveCount', {}).get('StringValue'),
+                'source': attributes.get('SourceQueueUrl', {}).get('StringValue'),
+                'body': message['Body'],
+            }))
+        print(f"{len(messages)} dead lettered messages")
+    else:
+        print(f"Replayed {replay(sqs, args.dlq_url, messages, args.queue_url)} of {len(messages)} dead lettered messages")
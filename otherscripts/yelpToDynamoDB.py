@@ -13,6 +13,16 @@ from time import sleep
 import boto3
 from decimal import Decimal
 import datetime
+import gzip
+import hashlib
+import math
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 
 
 API_KEY= ""
@@ -28,6 +38,140 @@ DEFAULT_TERM = 'dinner'
 DEFAULT_LOCATION = 'Manhattan'
 SEARCH_LIMIT = 50
 TABLE_NAME = 'yelp-restaurants'
+CUISINES = ['italian', 'chinese', 'indian', 'greek', 'mexican', 'spanish','american','japanese']
+# Yelp does not return results past the 1000th.
+MAX_RESULTS = 1000
+STATE_FILE = 'yelpIngestState.json'
+# Content hash of every record last written, to write only what changed.
+MANIFEST_FILE = 'yelpManifest.json'
+# Records written by each run, for the OpenSearch sync to reindex only those.
+CHANGE_LOG_FILE = 'yelpChangeLog.jsonl'
+# Most items in one BatchWriteItem.
+WRITE_BATCH_SIZE = 25
+MAX_WRITE_ATTEMPTS = 10
+# Write rate tried on an on-demand table, which reports no provisioned capacity.
+ON_DEMAND_WRITE_RATE = 1000
+THROTTLE_ERRORS = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+# Yelp responses kept on disk, so that re-runs do not spend API quota on pages we already have.
+CACHE_DIR = 'yelpCache'
+CACHE_TTL_SECONDS = 24 * 3600
+MAX_REQUEST_ATTEMPTS = 5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Opening hours are stored as one bitmap per weekday, Monday first, bit i being the half hour starting at i * 30 minutes.
+SLOTS_PER_DAY = 48
+SLOT_MINUTES = 30
+# Attributes added by the Business API enrichment, which a rewrite of the search fields keeps.
+DETAIL_ATTRIBUTES = ('hours', 'price_level')
+
+# One session for every request, so the fetch workers reuse their connections.
+session = requests.Session()
+
+
+class RateLimiter:
+    """Lets at most `rate` calls per second through acquire(), across threads."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            sleep(wait)
+
+
+rateLimiter = RateLimiter(5)
+
+
+class ResponseCache:
+    """
+    Gzipped JSON responses on disk, addressed by the hash of the path and the
+    sorted query parameters. An entry is fresh for `ttl` seconds after it was
+    fetched or revalidated; an older one is revalidated with its ETag.
+    In offline mode every request is answered from the cache, however old.
+    """
+
+    def __init__(self, directory, ttl=CACHE_TTL_SECONDS, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+    def path(self, path, params):
+        key = hashlib.sha256(json.dumps([path, sorted(params.items())], default=str).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json.gz')
+
+    def load(self, path, params):
+        """
+        Returns:
+            (dict, bool) : the cached entry or None, and whether it is still fresh
+        """
+        file = self.path(path, params)
+        try:
+            age = time.time() - os.stat(file).st_mtime
+            with gzip.open(file, 'rt', encoding='utf8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None, False
+        return entry, self.offline or age < self.ttl
+
+    def store(self, path, params, body, etag):
+        file = self.path(path, params)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        temporary = f"{file}.{threading.get_ident()}.tmp"
+        with gzip.open(temporary, 'wt', encoding='utf8') as f:
+            json.dump({'path': path, 'params': params, 'etag': etag, 'body': body}, f)
+        os.replace(temporary, file)
+
+    def touch(self, path, params):
+        """Marks an entry that the API confirmed unchanged as fresh again."""
+        os.utime(self.path(path, params))
+
+
+responseCache = None
+
+
+class CapacityBucket:
+    """
+    Token bucket of write capacity units shared by the writer threads. The rate
+    halves whenever DynamoDB throttles and creeps back up after every clean
+    batch, so the load settles at what the table really accepts.
+    """
+
+    def __init__(self, rate, maxRate):
+        self.rate = float(rate)
+        self.maxRate = float(maxRate)
+        self.tokens = self.rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # A request larger than the bucket goes through once the bucket is full.
+                needed = min(units, self.rate)
+                if self.tokens >= needed:
+                    self.tokens -= units
+                    return
+                wait = (needed - self.tokens) / self.rate
+            sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(1.0, self.rate / 2)
+            # Drain the bucket, but never owe more than a second at the new rate.
+            self.tokens = max(-self.rate, min(self.tokens, 0))
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + max(1.0, self.rate * 0.05))
 
 def createResource():
     return boto3.resource('dynamodb')
@@ -76,6 +220,8 @@ def createTable(dynamodb):
 
 def request(host, path, url_params=None):
     """Given your API_KEY, send a GET request to the API.
+    Responses are served from the response cache when it has a fresh copy,
+    and requests that hit the rate limit or a server error are retried.
 
     Args:
         host (str): The domain host of the API.
@@ -87,7 +233,7 @@ def request(host, path, url_params=None):
         dict: The JSON response from the request.
 
     Raises:
-        HTTPError: An error occurs from the HTTP request.
+        HTTPError: The API answered with an error, including a rate limit still hit after every retry.
     """
     url_params = url_params or {}
     url = '{0}{1}'.format(host, quote(path.encode('utf8')))
@@ -95,11 +241,39 @@ def request(host, path, url_params=None):
         'Authorization': 'Bearer %s' % API_KEY,
     }
 
+    cache = responseCache
+    entry = None
+    if cache:
+        entry, fresh = cache.load(path, url_params)
+        if fresh:
+            cache.stats['hits'] += 1
+            return entry['body']
+        if cache.offline:
+            raise LookupError(f"{url} {url_params} is not cached")
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+
     print(u'Querying {0} ...'.format(url))
 
-    response = requests.request('GET', url, headers=headers, params=url_params)
+    for attempt in range(MAX_REQUEST_ATTEMPTS):
+        rateLimiter.acquire()
+        response = session.get(url, headers=headers, params=url_params)
+        if response.status_code not in RETRY_STATUS_CODES:
+            break
+        backoff(attempt)
 
-    return response.json()
+    if cache:
+        if response.status_code == 304 and entry:
+            cache.stats['revalidated'] += 1
+            cache.touch(path, url_params)
+            return entry['body']
+        cache.stats['misses'] += 1
+    # An error body is not a result, callers keep their checkpoint and try again on the next run.
+    response.raise_for_status()
+    body = response.json()
+    if cache and response.status_code == 200:
+        cache.store(path, url_params, body, response.headers.get('ETag'))
+    return body
 
 
 def search(cuisine,offset):
@@ -172,35 +346,475 @@ def convertRecord(record,cuisine):
         
     return rec
 
-def processRecord(dynamodb,records,cuisine):
-    table = dynamodb.Table('yelp-restaurants')
+def business(businessId):
+    """Query the Business API for the details of one business.
+
+    Args:
+        businessId (str): The id of the business.
+
+    Returns:
+        dict: The JSON response from the request.
+    """
+    return request(API_HOST, BUSINESS_PATH + businessId)
+
+def hoursBitmap(hours):
+    """
+    Packs the regular opening hours of a business into one integer per weekday,
+    Monday first, whose bit i is set when it is open at the start of the i-th
+    half hour. Periods past midnight spill into the next day.
+    Args:
+        hours : the 'hours' list of a Business API response
+    Returns:
+        list : 7 ints, or None when Yelp has no regular hours
+    """
+    regular = next((entry for entry in hours or [] if entry.get('hours_type', 'REGULAR') == 'REGULAR'), None)
+    if regular is None:
+        return None
+    days = [0] * 7
+    for period in regular.get('open', []):
+        start = int(period['start'][:2]) * 60 + int(period['start'][2:])
+        end = int(period['end'][:2]) * 60 + int(period['end'][2:])
+        if end <= start:
+            end += 24 * 60
+        # Half hours that start while the business is open.
+        for slot in range(-(-start // SLOT_MINUTES), -(-end // SLOT_MINUTES)):
+            day = (period['day'] + slot // SLOTS_PER_DAY) % 7
+            days[day] |= 1 << (slot % SLOTS_PER_DAY)
+    return days
+
+def convertDetails(details):
+    """
+    Maps a Business API response to the attributes added to the stored records.
+    Returns:
+        dict : 'hours' bitmaps and 'price_level' (1 for $ to 4 for $$$$), when Yelp has them
+    """
+    attributes = {}
+    hours = hoursBitmap(details.get('hours'))
+    if hours is not None:
+        attributes['hours'] = [Decimal(day) for day in hours]
+    if details.get('price'):
+        attributes['price_level'] = Decimal(len(details['price']))
+    return attributes
+
+def recordKey(item):
+    return f"{item['id']}|{item['cuisine']}"
+
+def recordHash(item):
+    """Hash of a converted record without its timestamp, which changes on every run."""
+    content = {key: value for key, value in item.items() if key not in ('insertedAtTimestamp', 'content_hash')}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf8')).hexdigest()[:32]
+
+def loadManifest(path, dynamodb=None):
+    """
+    Reads the record hashes of the previous runs. Without a local manifest they
+    are read back from the content_hash attribute of the table when a resource is given.
+    Returns:
+        dict : record key to content hash
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    manifest = {}
+    if dynamodb is not None:
+        table = dynamodb.Table(TABLE_NAME)
+        kwargs = {'ProjectionExpression': 'id, cuisine, content_hash'}
+        while True:
+            response = table.scan(**kwargs)
+            for item in response['Items']:
+                if 'content_hash' in item:
+                    manifest[recordKey(item)] = item['content_hash']
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return manifest
+
+def saveManifest(path, manifest):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)
+
+def writeCapacity(dynamodb):
+    """
+    Returns:
+        (float, float) : the write rate to start at and the most to try, in WCU per second
+    """
+    provisioned = dynamodb.Table(TABLE_NAME).provisioned_throughput or {}
+    units = provisioned.get('WriteCapacityUnits') or 0
+    if units == 0:
+        return ON_DEMAND_WRITE_RATE, ON_DEMAND_WRITE_RATE
+    # Burst capacity lets a table absorb more than its provisioned rate for a while.
+    return units, units * 10
+
+def backoff(attempt):
+    # Full jitter, so throttled writers do not retry in lockstep.
+    sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+
+def writeBatch(dynamodb, items, bucket, stats):
+    """Writes up to 25 items with one BatchWriteItem and retries the unprocessed ones until all are written."""
+    # A batch may not hold the same key twice.
+    writes = list({recordKey(item): {'PutRequest': {'Item': item}} for item in items}.values())
+    attempt = 0
+    while writes:
+        if attempt >= MAX_WRITE_ATTEMPTS:
+            raise RuntimeError(f"{len(writes)} records still unprocessed after {attempt} attempts")
+        # About one unit per item, corrected with the consumed capacity below.
+        bucket.acquire(len(writes))
+        try:
+            response = dynamodb.batch_write_item(RequestItems={TABLE_NAME: writes}, ReturnConsumedCapacity='TOTAL')
+        except ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLE_ERRORS:
+                raise
+            stats['throttles'] += 1
+            bucket.throttled()
+            backoff(attempt)
+            attempt += 1
+            continue
+
+        consumed = sum(c.get('CapacityUnits', 0) for c in response.get('ConsumedCapacity', []))
+        if consumed > len(writes):
+            bucket.acquire(consumed - len(writes))
+        unprocessed = response.get('UnprocessedItems', {}).get(TABLE_NAME, [])
+        stats['written'] += len(writes) - len(unprocessed)
+        if unprocessed:
+            stats['throttles'] += 1
+            stats['retried'] += len(unprocessed)
+            bucket.throttled()
+            backoff(attempt)
+            attempt += 1
+        else:
+            bucket.succeeded()
+        writes = unprocessed
+
+def keepDetails(dynamodb, items):
+    """
+    Copies the detail attributes of the stored records into the items about to
+    replace them, since a PutRequest replaces the whole item.
+    Args:
+        items : list of converted records already in the table
+    """
+    byKey = {recordKey(item): item for item in items}
+    keys = [{'id': item['id'], 'cuisine': item['cuisine']} for item in byKey.values()]
+    names = {f"#{name}": name for name in ('id', 'cuisine') + DETAIL_ATTRIBUTES}
+    for start in range(0, len(keys), 100):
+        request = {TABLE_NAME: {'Keys': keys[start:start + 100], 'ProjectionExpression': ', '.join(names),
+                                'ExpressionAttributeNames': names}}
+        attempt = 0
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for stored in response['Responses'].get(TABLE_NAME, []):
+                for name in DETAIL_ATTRIBUTES:
+                    if name in stored:
+                        byKey[recordKey(stored)][name] = stored[name]
+            request = response.get('UnprocessedKeys')
+            if request:
+                backoff(attempt)
+                attempt += 1
+
+def processRecord(dynamodb,items,bucket,stats):
+    """
+    Writes already converted records to the table, paced by the capacity bucket.
+    Returns:
+        bool : whether every record was written
+    """
     try:
-        with table.batch_writer() as batch:
-            for record in records:
-                # batch.append(convertRecord(record,cuisine))py 
-                batch.put_item(Item=convertRecord(record,cuisine))
-                sleep(0.001)
+        for start in range(0, len(items), WRITE_BATCH_SIZE):
+            writeBatch(dynamodb, items[start:start + WRITE_BATCH_SIZE], bucket, stats)
+        return True
     except Exception as e:
         print("Error in inserting the record.")
-        pprint(e)        
+        pprint(e)
+        return False
+
+def loadState(path):
+    """
+    Reads the checkpoint of a previous run.
+    Returns:
+        dict : 'done' is the set of (cuisine, offset) pages already written,
+               'totals' the number of results Yelp reported per cuisine,
+               'details' the cuisines of every business still waiting for its details.
+    """
+    if not os.path.exists(path):
+        return {'done': set(), 'totals': {}, 'details': {}}
+    with open(path) as f:
+        state = json.load(f)
+    return {'done': {tuple(page) for page in state['done']}, 'totals': state['totals'],
+            'details': state.get('details', {})}
+
+def saveState(path, state):
+    # Written to a temporary file first so that a crash never leaves a truncated checkpoint.
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'done': sorted(state['done']), 'totals': state['totals'], 'details': state['details']}, f)
+    os.replace(tmp, path)
+
+def fetchPage(cuisine, offset, state, lock, pages):
+    """Fetches and converts one page of results, then queues it for the writer."""
+    try:
+        response = search(cuisine, offset)
+        businesses = response['businesses']
+    except Exception as e:
+        print(f"Could not fetch {cuisine} at offset {offset} : {e}")
+        return None
+    items = []
+    for record in businesses:
+        item = convertRecord(record, cuisine)
+        item['content_hash'] = recordHash(item)
+        items.append(item)
+    with lock:
+        state['totals'][cuisine] = min(response.get('total', 0), MAX_RESULTS)
+        if state['incremental']:
+            changed = [item for item in items if state['manifest'].get(recordKey(item)) != item['content_hash']]
+            state['unchanged'] += len(items) - len(changed)
+            items = changed
+    pages.put((cuisine, offset, items))
+    return response
+
+def logChanges(state, items):
+    """Records the written items in the manifest and appends them to the change log."""
+    now = datetime.datetime.now().isoformat()
+    with open(state['changeLogPath'], 'a') as log:
+        for item in items:
+            key = recordKey(item)
+            op = 'update' if key in state['manifest'] else 'insert'
+            state['manifest'][key] = item['content_hash']
+            log.write(json.dumps({'id': item['id'], 'cuisine': item['cuisine'], 'op': op,
+                                  'hash': item['content_hash'], 'at': now}) + '\n')
+
+def logDetails(state, businessId, cuisines):
+    """Appends the records given their details to the change log, so that the OpenSearch sync reindexes their hours."""
+    now = datetime.datetime.now().isoformat()
+    with open(state['changeLogPath'], 'a') as log:
+        for cuisine in cuisines:
+            log.write(json.dumps({'id': businessId, 'cuisine': cuisine, 'op': 'details', 'at': now}) + '\n')
+
+def writePage(dynamodb, page, state, lock, statePath):
+    """Writes one queued page, then records it in the manifest, the change log and the checkpoint."""
+    cuisine, offset, items = page
+    with lock:
+        known = [item for item in items if recordKey(item) in state['manifest']]
+    try:
+        keepDetails(dynamodb, known)
+    except Exception as e:
+        print(f"Could not read the details of {cuisine} at offset {offset} : {e}")
+        return
+    if processRecord(dynamodb, items, state['bucket'], state['writeStats']):
+        with lock:
+            # Only businesses seen for the first time are enriched, the others kept their details.
+            new = [item for item in items if recordKey(item) not in state['manifest']]
+            logChanges(state, items)
+            saveManifest(state['manifestPath'], state['manifest'])
+            state['done'].add((cuisine, offset))
+            for item in new:
+                cuisines = state['details'].setdefault(item['id'], [])
+                if item['cuisine'] not in cuisines:
+                    cuisines.append(item['cuisine'])
+            saveState(statePath, state)
+            state['written'] += len(items)
+        print(f"{len(items)} records of {cuisine} at offset {offset} inserted.")
+
+def writePages(pages, state, lock, statePath):
+    """
+    Writer thread: writes queued pages until it receives None and checkpoints each written page.
+    A page that fails is logged and left out of the checkpoint for the next run, and the
+    writer keeps draining the queue, since the fetchers block on it while it is full.
+    """
+    dynamodb = None
+    while True:
+        page = pages.get()
+        try:
+            if page is None:
+                return
+            if dynamodb is None:
+                # Resources are not thread safe, so every writer gets its own.
+                dynamodb = boto3.session.Session().resource('dynamodb')
+            writePage(dynamodb, page, state, lock, statePath)
+        except Exception as e:
+            print(f"Could not write {page[0]} at offset {page[1]} : {e}")
+        finally:
+            pages.task_done()
+
+def writeDetails(dynamodb, businessId, cuisines, attributes, bucket, stats):
+    """Adds the detail attributes to the record of the business under every cuisine it was found for."""
+    table = dynamodb.Table(TABLE_NAME)
+    names = sorted(attributes)
+    for cuisine in cuisines:
+        attempt = 0
+        while True:
+            bucket.acquire(1)
+            try:
+                table.update_item(
+                    Key={'id': businessId, 'cuisine': cuisine},
+                    UpdateExpression='SET ' + ', '.join(f"#{name} = :{name}" for name in names),
+                    ExpressionAttributeNames={f"#{name}": name for name in names},
+                    ExpressionAttributeValues={f":{name}": attributes[name] for name in names},
+                )
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] not in THROTTLE_ERRORS or attempt + 1 >= MAX_WRITE_ATTEMPTS:
+                    raise
+                stats['throttles'] += 1
+                bucket.throttled()
+                backoff(attempt)
+                attempt += 1
+        bucket.succeeded()
+
+def enrich(state, lock, statePath, workers):
+    """
+    Fetches the details of every business first written by this or an unfinished
+    earlier run on a pool of workers, sharing the Yelp rate limiter and cache,
+    and stores their opening hours and price level. Every enriched record goes to the change log.
+    Returns:
+        int : the number of businesses enriched
+    """
+    local = threading.local()
+    pending = dict(state['details'])
+
+    def enrichOne(businessId):
+        # Resources are not thread safe, so every worker gets its own.
+        if not hasattr(local, 'dynamodb'):
+            local.dynamodb = boto3.session.Session().resource('dynamodb')
+        try:
+            attributes = convertDetails(business(businessId))
+            if attributes:
+                writeDetails(local.dynamodb, businessId, pending[businessId], attributes,
+                             state['bucket'], state['writeStats'])
+        except Exception as e:
+            print(f"Could not enrich {businessId} : {e}")
+            return 0
+        with lock:
+            if attributes:
+                logDetails(state, businessId, pending[businessId])
+            del state['details'][businessId]
+            saveState(statePath, state)
+        return 1
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(enrichOne, pending))
+
+def ingest(dynamodb, cuisines, workers, statePath, incremental=False,
+           manifestPath=MANIFEST_FILE, changeLogPath=CHANGE_LOG_FILE, writers=None, details=True):
+    """
+    Fetches every page of every cuisine on a pool of workers and streams the
+    converted records to writer threads, so that fetching, conversion and
+    writing overlap. Pages written by an earlier run are skipped.
+    The writers share a capacity bucket that adapts to throttling, and their
+    number follows the table capacity unless given.
+    In incremental mode only the records whose content hash differs from the
+    manifest are written. Every written record goes to the change log.
+    Unless details is False, the businesses written for the first time are then
+    enriched with their opening hours and price level. Rewritten records keep theirs.
+    Returns:
+        (list, dict) : the pages that could not be inserted, and the write statistics
+    """
+    state = loadState(statePath)
+    state.update({
+        'incremental': incremental,
+        'manifest': loadManifest(manifestPath, dynamodb),
+        'manifestPath': manifestPath,
+        'changeLogPath': changeLogPath,
+        'written': 0,
+        'unchanged': 0,
+    })
+    rate, maxRate = writeCapacity(dynamodb)
+    state['bucket'] = CapacityBucket(rate, maxRate)
+    # A writer keeps about 25 units per second busy, more threads only pay off on a larger table.
+    writers = writers or max(1, min(8, math.ceil(rate / WRITE_BATCH_SIZE)))
+    stats = {'written': 0, 'throttles': 0, 'retried': 0}
+    # Updated by every writer, the GIL keeps the increments from being lost.
+    state['writeStats'] = stats
+    started = time.monotonic()
+    lock = threading.Lock()
+    # Bounded, so fetching cannot run arbitrarily far ahead of the writer.
+    pages = queue.Queue(maxsize=workers * 2)
+    writerThreads = [threading.Thread(target=writePages, args=(pages, state, lock, statePath)) for _ in range(writers)]
+    for writer in writerThreads:
+        writer.start()
+
+    def pending(cuisine, offsets):
+        return [(cuisine, offset) for offset in offsets if (cuisine, offset) not in state['done']]
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # The first page tells how many results each cuisine has, unless a previous run already knows.
+            unknown = [cuisine for cuisine in cuisines if cuisine not in state['totals']]
+            list(pool.map(lambda cuisine: fetchPage(cuisine, 0, state, lock, pages), unknown))
+
+            rest = []
+            for cuisine in cuisines:
+                if cuisine not in state['totals']:
+                    continue
+                first = SEARCH_LIMIT if cuisine in unknown else 0
+                rest += pending(cuisine, range(first, state['totals'][cuisine], SEARCH_LIMIT))
+            list(pool.map(lambda page: fetchPage(page[0], page[1], state, lock, pages), rest))
+    finally:
+        for writer in writerThreads:
+            pages.put(None)
+        for writer in writerThreads:
+            writer.join()
+    elapsed = time.monotonic() - started
+    enriched = enrich(state, lock, statePath, workers) if details else 0
+
+    missing = [page for cuisine in cuisines if cuisine in state['totals']
+               for page in pending(cuisine, range(0, state['totals'][cuisine], SEARCH_LIMIT))]
+    missing += [(cuisine, 0) for cuisine in cuisines if cuisine not in state['totals']]
+    return missing, {
+        'written': state['written'],
+        'unchanged': state['unchanged'],
+        'throttles': stats['throttles'],
+        'retried': stats['retried'],
+        'writers': writers,
+        'items_per_second': stats['written'] / elapsed if elapsed else 0,
+        'final_rate': state['bucket'].rate,
+        'enriched': enriched,
+        'details_pending': len(state['details']) if details else 0,
+    }
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Loads Yelp restaurants into DynamoDB.')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent Yelp requests.')
+    parser.add_argument('--rate', type=float, default=5, help='Most Yelp requests per second.')
+    parser.add_argument('--state-file', default=STATE_FILE, help='Checkpoint of the pages already written.')
+    parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and fetch everything again.')
+    parser.add_argument('--incremental', action='store_true', help='Only write new or changed records.')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='Content hashes of the records already written.')
+    parser.add_argument('--change-log', default=CHANGE_LOG_FILE, help='Where the written records are logged for the OpenSearch sync.')
+    parser.add_argument('--writers', type=int, help='DynamoDB writer threads, sized from the table capacity by default.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Where Yelp responses are cached.')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL_SECONDS, help='Seconds before a cached response is revalidated.')
+    parser.add_argument('--no-cache', action='store_true', help='Always query Yelp and cache nothing.')
+    parser.add_argument('--skip-details', action='store_true', help='Do not fetch the opening hours and price of the businesses written for the first time.')
+    parser.add_argument('--offline', action='store_true', help='Replay the cached responses only, without querying Yelp.')
+    args = parser.parse_args()
+
+    if args.offline and args.no_cache:
+        parser.error('--offline needs the cache')
+    # Cached pages are read at disk speed, the limiter only guards the API quota.
+    rateLimiter = RateLimiter(float('inf') if args.offline else args.rate)
+    if not args.no_cache:
+        responseCache = ResponseCache(args.cache_dir, args.cache_ttl, args.offline)
+    if args.restart and os.path.exists(args.state_file):
+        os.remove(args.state_file)
+
     dynamoDB = createResource()
     createTable(dynamoDB)
     print("Table Created Successfully")
-    cuisines = ['italian', 'chinese', 'indian', 'greek', 'mexican', 'spanish','american','japanese']
-    
-    
-    for cuisine in cuisines:
-        offset = 0
-        while offset < 1000:
-            records = search(cuisine, offset)
-            if(len(records['businesses']) > 0):
-                processRecord(dynamoDB,records['businesses'],cuisine)
-                offset += SEARCH_LIMIT
-                print(f"{offset} records of {cuisine} inserted.")
-            else:
-                offset += SEARCH_LIMIT
-                break
-                
-    print("All records inserted")
\ No newline at end of file
+
+    missing, counts = ingest(dynamoDB, CUISINES, args.workers, args.state_file,
+                             args.incremental, args.manifest, args.change_log, args.writers,
+                             not args.skip_details)
+    print(f"{counts['written']} records written, {counts['unchanged']} unchanged, "
+          f"{counts['items_per_second']:.1f} items/sec with {counts['writers']} writers.")
+    print(f"{counts['throttles']} throttled batches, {counts['retried']} items retried, "
+          f"write rate settled at {counts['final_rate']:.1f} WCU/s.")
+    if responseCache:
+        print(f"Yelp cache: {responseCache.stats['hits']} hits, {responseCache.stats['revalidated']} revalidated, "
+              f"{responseCache.stats['misses']} fetched.")
+    print(f"{counts['enriched']} businesses enriched with their opening hours and price.")
+    if missing or counts['details_pending']:
+        print(f"{len(missing)} pages could not be inserted and {counts['details_pending']} businesses "
+              f"are missing their details, run again to resume.")
+    else:
+        if os.path.exists(args.state_file):
+            os.remove(args.state_file)
+        print("All records inserted")
@@ -0,0 +1,30 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+LAMBDA_DIR = os.path.join(ROOT, 'lambdafunctions')
+sys.path.insert(0, LAMBDA_DIR)
+sys.path.insert(0, os.path.join(ROOT, 'otherscripts'))
+# boto3 clients are only ever replaced by fakes here, they must not find real credentials.
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+
+def loadHandler(filename, name):
+    # The handlers' file names have spaces, so they cannot be imported by name.
+    spec = importlib.util.spec_from_file_location(name, os.path.join(LAMBDA_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def lf1():
+    return loadHandler('LF1 Lambda.py', 'lf1')
+
+@pytest.fixture(scope='session')
+def lf2():
+    pytest.importorskip('opensearchpy')
+    return loadHandler('LF2 Lambda.py', 'lf2')
@@ -0,0 +1,115 @@
+import smtplib
+
+import pytest
+from botocore.exceptions import ClientError
+
+import emailDelivery
+
+
+def sesError(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'SendRawEmail')
+
+
+class FakeSES:
+    """Records every send_raw_email, and raises the errors queued for it or for a refused address."""
+
+    def __init__(self):
+        self.sends = []
+        self.errors = []
+        self.refused = set()
+
+    def send_raw_email(self, Source, Destinations, RawMessage):
+        self.sends.append(list(Destinations))
+        if self.errors:
+            raise self.errors.pop(0)
+        if self.refused.intersection(Destinations):
+            raise sesError('MessageRejected')
+        return {'MessageId': str(len(self.sends))}
+
+
+@pytest.fixture
+def ses(monkeypatch):
+    client = FakeSES()
+    monkeypatch.setattr(emailDelivery, 'getClient', lambda service: client)
+    monkeypatch.setattr(emailDelivery, 'EMAIL_BACKEND', 'ses')
+    monkeypatch.setattr(emailDelivery, 'rateLimiter', emailDelivery.SendRateLimiter(1e6))
+    monkeypatch.setattr(emailDelivery, 'SEND_BACKOFF_SECONDS', 0)
+    monkeypatch.setattr(emailDelivery, 'emailStats', dict.fromkeys(emailDelivery.emailStats, 0))
+    return client
+
+
+def hits(*ids):
+    return [{'_id': id, '_source': {'name': id.title(), 'address': f'{id} street'}} for id in ids]
+
+
+def test_same_list_is_rendered_and_sent_once(ses):
+    deliveries = [('m1', 'a@example.com', hits('x', 'y')), ('m2', 'b@example.com', hits('x', 'y')),
+                  ('m3', 'c@example.com', hits('z'))]
+    assert emailDelivery.deliverEmails(deliveries) == []
+    assert sorted(ses.sends) == [['a@example.com', 'b@example.com'], ['c@example.com']]
+    assert emailDelivery.emailStats['renders'] == 2
+    assert emailDelivery.emailStats['recipients'] == 3
+
+
+def test_repeated_address_gets_one_email(ses):
+    deliveries = [('m1', 'a@example.com', hits('x')), ('m2', 'a@example.com', hits('x'))]
+    assert emailDelivery.deliverEmails(deliveries) == []
+    assert ses.sends == [['a@example.com']]
+
+
+def test_large_groups_are_sent_in_chunks(ses):
+    deliveries = [(f'm{n}', f'user{n}@example.com', hits('x')) for n in range(emailDelivery.MAX_RECIPIENTS + 1)]
+    assert emailDelivery.deliverEmails(deliveries) == []
+    assert [len(send) for send in ses.sends] == [emailDelivery.MAX_RECIPIENTS, 1]
+
+
+def test_missing_email_fails_and_empty_hits_are_skipped(ses):
+    deliveries = [('m1', None, hits('x')), ('m2', 'b@example.com', []), ('m3', 'c@example.com', hits('x'))]
+    assert emailDelivery.deliverEmails(deliveries) == ['m1']
+    assert ses.sends == [['c@example.com']]
+    assert emailDelivery.emailStats['empty'] == 1
+
+
+def test_throttled_group_is_retried_whole(ses):
+    ses.errors = [sesError('Throttling'), sesError('ThrottlingException')]
+    deliveries = [('m1', 'a@example.com', hits('x')), ('m2', 'b@example.com', hits('x'))]
+    assert emailDelivery.deliverEmails(deliveries) == []
+    assert ses.sends == [['a@example.com', 'b@example.com']] * 3
+    assert emailDelivery.emailStats['throttles'] == 2
+
+
+def test_group_throttled_on_every_attempt_fails(ses):
+    ses.errors = [sesError('Throttling')] * emailDelivery.SEND_ATTEMPTS
+    deliveries = [('m1', 'a@example.com', hits('x')), ('m2', 'b@example.com', hits('x'))]
+    assert sorted(emailDelivery.deliverEmails(deliveries)) == ['m1', 'm2']
+    assert len(ses.sends) == emailDelivery.SEND_ATTEMPTS
+
+
+def test_rejected_group_is_split_to_find_the_refused_address(ses):
+    ses.refused = {'bad@example.com'}
+    deliveries = [('m1', 'a@example.com', hits('x')), ('m2', 'bad@example.com', hits('x')),
+                  ('m3', 'c@example.com', hits('x'))]
+    assert emailDelivery.deliverEmails(deliveries) == ['m2']
+    assert ses.sends[0] == ['a@example.com', 'bad@example.com', 'c@example.com']
+    assert ses.sends[1:] == [['a@example.com'], ['bad@example.com'], ['c@example.com']]
+
+
+def test_other_errors_fail_the_chunk_without_splitting(ses):
+    ses.errors = [sesError('AccessDenied')]
+    deliveries = [('m1', 'a@example.com', hits('x')), ('m2', 'b@example.com', hits('x'))]
+    assert sorted(emailDelivery.deliverEmails(deliveries)) == ['m1', 'm2']
+    assert len(ses.sends) == 1
+
+
+def test_smtp_errors_are_classified_by_reply_code():
+    assert emailDelivery.isThrottle(smtplib.SMTPResponseException(451, 'try later'))
+    assert not emailDelivery.isThrottle(smtplib.SMTPResponseException(554, 'no'))
+    assert emailDelivery.isRejection(smtplib.SMTPRecipientsRefused({'a@example.com': (550, 'no')}))
+    assert not emailDelivery.isRejection(sesError('Throttling'))
+
+
+def test_bodies_escape_html_and_link_yelp():
+    hit = {'_id': 'x', '_source': {'name': 'Fish & Chips', 'address': '1 <Main> St', 'yelp_url': 'https://yelp.com/x'}}
+    text, body = emailDelivery.renderBodies([hit])
+    assert '1. Fish & Chips located at 1 <Main> St' in text
+    assert '<a href="https://yelp.com/x">Fish &amp; Chips</a> located at 1 &lt;Main&gt; St' in body
@@ -0,0 +1,152 @@
+import importlib
+
+import pytest
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+import idempotency
+
+
+def conditionFailed(item):
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'failed'}, 'Item': item}, 'PutItem')
+
+
+class FakeDedupTable:
+    """The conditional writes idempotency.py makes, against a dict keyed by request key."""
+
+    def __init__(self):
+        self.items = {}
+
+    def put_item(self, TableName, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                 ReturnValuesOnConditionCheckFailure):
+        key = Item['request_key']['S']
+        now = int(ExpressionAttributeValues[':now']['N'])
+        old = self.items.get(key)
+        if old is not None and not (int(old['expires_at']['N']) < now or
+                                    (old['state']['S'] == 'in_progress' and int(old['lease_until']['N']) < now)):
+            raise conditionFailed(old)
+        self.items[key] = dict(Item)
+
+    def get_item(self, TableName, Key, ConsistentRead):
+        item = self.items.get(Key['request_key']['S'])
+        return {'Item': item} if item else {}
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues):
+        item = self.items.get(Key['request_key']['S'])
+        if item is None or item['claim_id'] != ExpressionAttributeValues[':claim']:
+            raise conditionFailed(item)
+        item['state'] = ExpressionAttributeValues[':done']
+        item['expires_at'] = ExpressionAttributeValues[':expires']
+        item.pop('lease_until', None)
+
+    def delete_item(self, TableName, Key, ConditionExpression, ExpressionAttributeValues):
+        item = self.items.get(Key['request_key']['S'])
+        if item is None or item['claim_id'] != ExpressionAttributeValues[':claim']:
+            raise conditionFailed(item)
+        del self.items[Key['request_key']['S']]
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    # Fresh warm window, claims and counters for every test.
+    module = importlib.reload(idempotency)
+    table = FakeDedupTable()
+    monkeypatch.setattr(module, 'getClient', lambda service: table)
+    return module, table
+
+
+def test_first_claim_is_claimed_and_redelivery_after_settle_is_duplicate(dedup):
+    module, table = dedup
+    assert module.claim(['a']) == {'a': 'claimed'}
+    module.settle(['a'], [])
+    assert table.items['a']['state']['S'] == 'done'
+
+    # A warm environment answers from its window, a cold one from the table.
+    assert module.claim(['a']) == {'a': 'duplicate'}
+    assert module.dedupStats['window_hits'] == 1
+    module.doneWindow.clear()
+    assert module.claim(['a']) == {'a': 'duplicate'}
+    assert module.dedupStats['table_hits'] == 1
+
+
+def test_request_held_by_another_worker_is_busy(dedup):
+    module, table = dedup
+    assert module.claim(['a']) == {'a': 'claimed'}
+    table.items['a']['claim_id'] = {'S': 'another worker'}
+    module.ownClaims.clear()
+    assert module.claim(['a']) == {'a': 'busy'}
+    assert module.dedupStats['in_progress'] == 1
+
+
+def test_expired_lease_is_taken_over(dedup):
+    module, table = dedup
+    module.claim(['a'])
+    table.items['a']['lease_until'] = {'N': '0'}
+    assert module.claim(['a']) == {'a': 'claimed'}
+
+
+def test_failed_request_is_released_and_claimed_again(dedup):
+    module, table = dedup
+    module.claim(['a'])
+    module.settle([], ['a'])
+    assert 'a' not in table.items
+    assert module.dedupStats['released'] == 1
+    assert module.claim(['a']) == {'a': 'claimed'}
+
+
+def test_settle_leaves_other_workers_claims_alone(dedup):
+    module, table = dedup
+    module.claim(['a'])
+    table.items['a']['claim_id'] = {'S': 'another worker'}
+    module.settle(['a'], [])
+    assert table.items['a']['state']['S'] == 'in_progress'
+    assert module.dedupStats['store_errors'] == 1
+
+
+def test_connection_error_is_unrecorded(dedup, monkeypatch):
+    module, table = dedup
+
+    def timeout(**kwargs):
+        raise ReadTimeoutError(endpoint_url='https://dynamodb')
+    monkeypatch.setattr(table, 'put_item', timeout)
+    assert module.claim(['a', 'b']) == {'a': 'unrecorded', 'b': 'unrecorded'}
+    assert module.dedupStats['store_errors'] == 2
+
+
+def test_throttled_table_is_busy(dedup, monkeypatch):
+    module, table = dedup
+
+    def throttled(**kwargs):
+        raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'slow down'}}, 'PutItem')
+    monkeypatch.setattr(table, 'put_item', throttled)
+    assert module.claim(['a']) == {'a': 'busy'}
+
+
+def test_unreadable_holder_is_busy(dedup, monkeypatch):
+    module, table = dedup
+    module.claim(['a'])
+
+    def failedWithoutItem(**kwargs):
+        raise conditionFailed(None)
+
+    def timeout(**kwargs):
+        raise ReadTimeoutError(endpoint_url='https://dynamodb')
+    monkeypatch.setattr(table, 'put_item', failedWithoutItem)
+    monkeypatch.setattr(table, 'get_item', timeout)
+    assert module.claim(['a']) == {'a': 'busy'}
+
+
+def test_without_table_everything_is_unrecorded(dedup, monkeypatch):
+    module, _ = dedup
+    monkeypatch.setattr(module, 'DEDUP_TABLE', '')
+    assert module.claim(['a']) == {'a': 'unrecorded'}
+    module.settle(['a'], [])
+    assert module.claim(['a']) == {'a': 'duplicate'}
+
+
+def test_message_key_prefers_the_idempotency_attribute(dedup):
+    module, _ = dedup
+    message = {'messageAttributes': {'IdempotencyKey': {'stringValue': 'k1', 'dataType': 'String'}}}
+    assert module.messageKey(message, {'cuisine': 'indian'}) == 'k1'
+    assert module.messageKey({}, {'cuisine': 'indian', 'email': 'a@b.com'}) == \
+        module.messageKey({}, {'email': 'a@b.com', 'cuisine': 'indian'})
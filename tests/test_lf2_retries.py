@@ -0,0 +1,133 @@
+import json
+
+import pytest
+
+QUEUE = 'https://sqs.us-east-1.amazonaws.com/123456789012/restaurants'
+DLQ = 'https://sqs.us-east-1.amazonaws.com/123456789012/restaurants-dlq'
+
+
+class FakeSQS:
+    """Records the visibility changes and dead letters scheduleRetries asks for."""
+
+    def __init__(self):
+        self.visibility = {}
+        self.deadLetters = []
+        self.failVisibility = False
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        if self.failVisibility:
+            raise ConnectionError('unreachable')
+        for entry in Entries:
+            self.visibility[entry['ReceiptHandle']] = entry['VisibilityTimeout']
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes):
+        self.deadLetters.append((QueueUrl, MessageBody, MessageAttributes))
+
+
+def message(id, receives=1, body=None):
+    body = body if body is not None else {'cuisine': 'indian', 'location': 'manhattan', 'email': f'{id}@example.com'}
+    return {'messageId': id, 'receiptHandle': f'handle-{id}', 'body': json.dumps(body), 'queueUrl': QUEUE,
+            'attributes': {'ApproximateReceiveCount': str(receives)}, 'messageAttributes': {}}
+
+
+@pytest.fixture
+def retries(lf2, monkeypatch):
+    monkeypatch.setattr(lf2, 'DLQ_URL', DLQ)
+    monkeypatch.setattr(lf2, 'retryStats', dict.fromkeys(lf2.retryStats, 0))
+    return lf2, FakeSQS()
+
+
+@pytest.mark.parametrize('receives', [1, 2, 3, 10, 100])
+def test_retry_delay_backs_off_with_jitter_up_to_the_maximum(lf2, receives):
+    delay = min(lf2.RETRY_MAX_SECONDS, lf2.RETRY_BASE_SECONDS * 2 ** (receives - 1))
+    for _ in range(50):
+        assert delay // 2 <= lf2.retryDelay(receives) <= delay
+
+
+def test_failed_messages_are_delayed(retries):
+    lf2, sqs = retries
+    assert lf2.scheduleRetries(sqs, [message('a'), message('b', receives=3)]) == [message('a'), message('b', receives=3)]
+    assert lf2.RETRY_BASE_SECONDS // 2 <= sqs.visibility['handle-a'] <= lf2.RETRY_BASE_SECONDS
+    assert sqs.visibility['handle-b'] >= lf2.RETRY_BASE_SECONDS * 2
+    assert sqs.deadLetters == []
+    assert lf2.retryStats['retried'] == 2
+
+
+def test_message_received_too_often_is_dead_lettered(retries):
+    lf2, sqs = retries
+    assert lf2.scheduleRetries(sqs, [message('a', receives=lf2.MAX_RECEIVES)]) == []
+    [(url, body, attributes)] = sqs.deadLetters
+    assert url == DLQ and json.loads(body)['email'] == 'a@example.com'
+    assert attributes['SourceQueueUrl']['StringValue'] == QUEUE
+    assert attributes['ReceiveCount']['StringValue'] == str(lf2.MAX_RECEIVES)
+    assert lf2.retryStats['dead_lettered'] == 1
+
+
+def test_busy_messages_are_never_dead_lettered(retries):
+    lf2, sqs = retries
+    busy = message('a', receives=lf2.MAX_RECEIVES + 5)
+    assert lf2.scheduleRetries(sqs, [busy], {'a'}) == [busy]
+    assert sqs.visibility == {'handle-a': lf2.BUSY_RETRY_SECONDS}
+    assert sqs.deadLetters == []
+    assert lf2.retryStats == {'retried': 0, 'busy': 1, 'dead_lettered': 0}
+
+
+def test_without_dlq_messages_keep_being_retried(retries, monkeypatch):
+    lf2, sqs = retries
+    monkeypatch.setattr(lf2, 'DLQ_URL', None)
+    assert lf2.scheduleRetries(sqs, [message('a', receives=lf2.MAX_RECEIVES)]) == [message('a', receives=lf2.MAX_RECEIVES)]
+    assert sqs.deadLetters == []
+    assert 'handle-a' in sqs.visibility
+
+
+def test_message_that_cannot_be_dead_lettered_is_retried(retries, monkeypatch):
+    lf2, sqs = retries
+
+    def unreachable(**kwargs):
+        raise ConnectionError('unreachable')
+    monkeypatch.setattr(sqs, 'send_message', unreachable)
+    assert lf2.scheduleRetries(sqs, [message('a', receives=lf2.MAX_RECEIVES)]) == [message('a', receives=lf2.MAX_RECEIVES)]
+    assert lf2.retryStats['dead_lettered'] == 0
+
+
+def test_failed_visibility_change_still_reports_the_retry(retries):
+    lf2, sqs = retries
+    sqs.failVisibility = True
+    assert lf2.scheduleRetries(sqs, [message('a')]) == [message('a')]
+    assert lf2.retryStats['retried'] == 0
+
+
+@pytest.fixture
+def batch(lf2, monkeypatch):
+    """processBatch with every claim granted, and the searches and emails recorded."""
+    settled = []
+    deliveries = []
+    monkeypatch.setattr(lf2, 'claim', lambda keys: dict.fromkeys(keys, 'claimed'))
+    monkeypatch.setattr(lf2, 'settle', lambda done, failed: settled.append((sorted(done), sorted(failed))))
+    monkeypatch.setattr(lf2, 'saveUserState', lambda body: None)
+    monkeypatch.setattr(lf2, 'fetchRecommendations', lambda keys: {key: [{'_id': 'x', '_source': {}}] for key in keys})
+
+    def deliver(batchDeliveries):
+        deliveries.extend(batchDeliveries)
+        return []
+    monkeypatch.setattr(lf2, 'deliverEmails', deliver)
+    return lf2, settled, deliveries
+
+
+def test_messages_that_can_never_succeed_are_handled(batch):
+    lf2, settled, deliveries = batch
+    broken = dict(message('a'), body='not json')
+    noEmail = message('b', body={'cuisine': 'indian', 'location': 'manhattan'})
+    blankEmail = message('c', body={'cuisine': 'indian', 'location': 'manhattan', 'email': ' '})
+    assert lf2.processBatch([broken, noEmail, blankEmail, message('d')]) == ([], [])
+    assert [delivery[0] for delivery in deliveries] == ['d']
+
+
+def test_busy_and_failed_messages_are_reported_apart(batch, monkeypatch):
+    lf2, settled, deliveries = batch
+    monkeypatch.setattr(lf2, 'claim', lambda keys: dict(zip(keys, ['claimed', 'busy'])))
+    monkeypatch.setattr(lf2, 'fetchRecommendations', lambda keys: {})
+    held = message('b', body={'cuisine': 'greek', 'location': 'manhattan', 'email': 'b@example.com'})
+    assert lf2.processBatch([message('a'), held]) == (['a'], ['b'])
+    assert len(settled) == 1 and settled[0][0] == []
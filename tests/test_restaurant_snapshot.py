@@ -0,0 +1,96 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('opensearchpy')
+import restaurantSnapshot as ranking
+from exportSnapshot import ALWAYS_OPEN, buildColumns, writeSnapshot
+
+# 18:00 to 22:00 every day, half hours 36 to 43.
+EVENINGS = sum(1 << slot for slot in range(36, 44))
+MONDAY = datetime.datetime(2024, 3, 4, 12, 0, tzinfo=ranking.TIMEZONE)
+
+
+def restaurant(id, cuisine, rating, reviews, hours=None, zip_code='10001'):
+    doc = {'id': id, 'cuisine': cuisine, 'name': id.title(), 'address': f'{id} street', 'rating': rating,
+           'review_count': reviews, 'latitude': 40.75, 'longitude': -73.99, 'zip_code': zip_code}
+    if hours is not None:
+        doc['hours'] = [hours] * 7
+    return doc
+
+
+@pytest.fixture(scope='module')
+def snap(tmp_path_factory):
+    docs = [
+        restaurant('tandoor', 'indian', 4.5, 120),
+        restaurant('masala', 'indian', 4.5, 300),
+        restaurant('curry', 'indian', 4.0, 900, hours=EVENINGS),
+        restaurant('dosa', 'indian', 3.5, 50, hours=0),
+        restaurant('gyro', 'greek', 5.0, 10, zip_code='10013'),
+    ]
+    path = str(tmp_path_factory.mktemp('snapshot') / 'restaurants.snapshot')
+    columns, header = buildColumns(docs)
+    writeSnapshot(path, columns, header)
+    return ranking.loadSnapshot(path)
+
+
+def names(hits):
+    return [hit['_source']['name'] for hit in hits]
+
+
+def test_open_at_is_the_half_hour_of_today():
+    assert ranking.openAt('18:30', MONDAY) == (0, 37)
+    assert ranking.openAt('00:00', MONDAY) == (0, 0)
+    for invalid in (None, '', '25:00', '18:60', 'soon'):
+        assert ranking.openAt(invalid, MONDAY) is None
+
+
+@pytest.mark.parametrize('hours', [[EVENINGS] * 7, [Decimal(EVENINGS)] * 7, [float(EVENINGS)] * 7])
+def test_is_open_checks_the_bit_of_the_half_hour(hours):
+    hit = {'_source': {'hours': hours}}
+    assert ranking.isOpen(hit, (0, 36))
+    assert ranking.isOpen(hit, (6, 43))
+    assert not ranking.isOpen(hit, (0, 35))
+    assert not ranking.isOpen(hit, (0, 44))
+
+
+def test_unknown_hours_or_time_count_as_open():
+    assert ranking.isOpen({'_source': {}}, (0, 10))
+    assert ranking.isOpen({'_source': {'hours': [0] * 7}}, None)
+
+
+def test_top_k_ranks_by_rating_then_reviews(snap):
+    assert names(ranking.snapshotTopK(snap, 'indian', 5)) == ['Masala', 'Tandoor', 'Curry', 'Dosa']
+    assert names(ranking.snapshotTopK(snap, 'indian', 2)) == ['Masala', 'Tandoor']
+
+
+def test_top_k_drops_the_restaurants_closed_at_the_time(snap):
+    # Unknown hours are stored as always open.
+    assert names(ranking.snapshotTopK(snap, 'indian', 5, (2, 37))) == ['Masala', 'Tandoor', 'Curry']
+    assert names(ranking.snapshotTopK(snap, 'indian', 5, (2, 20))) == ['Masala', 'Tandoor']
+
+
+def test_top_k_of_an_unknown_cuisine_is_none(snap):
+    assert ranking.snapshotTopK(snap, 'thai', 5) is None
+
+
+def test_hits_look_like_opensearch_hits(snap):
+    hit = ranking.snapshotTopK(snap, 'greek', 1)[0]
+    assert hit['_id'] == 'gyro-greek'
+    source = hit['_source']
+    assert source['rating'] == 5.0 and source['review_count'] == 10
+    assert source['zip_code'] == '10013' and source['cuisine'] == 'greek'
+    assert source['hours'] == [ALWAYS_OPEN] * 7
+
+
+def test_recommendations_without_snapshot_are_left_to_opensearch():
+    assert ranking.snapshotRecommendations(None, ('indian', 'manhattan', None)) is None
+
+
+def test_recommendations_of_a_request_key(snap, monkeypatch):
+    monkeypatch.setattr(ranking, 'RANKING_MODE', 'rating')
+    key = ranking.requestKey({'cuisine': ' Indian ', 'location': 'Manhattan', 'dining_time': None})
+    assert key == ('indian', 'manhattan', None)
+    assert names(ranking.snapshotRecommendations(snap, key)) == ['Masala', 'Tandoor', 'Curry', 'Dosa']
@@ -0,0 +1,72 @@
+import pytest
+
+
+def slots(location='manhattan', cuisine=None, num_people=None, time=None, email=None):
+    return (location, cuisine, num_people, time, email)
+
+
+def violated(lf1, *args, **kwargs):
+    return [slot for slot, _ in lf1.validate_slots(slots(*args, **kwargs))]
+
+
+def test_filled_request_is_valid(lf1):
+    assert lf1.validate_slots(slots('Manhattan', 'Indian', '4', '18:30', 'someone@example.com')) == []
+    assert lf1.validate_dining_suggestion('new york', 'greek', '2', '20:59', None)['isValid']
+
+
+def test_missing_location_stops_the_checks(lf1):
+    assert lf1.validate_slots(slots(None, 'thai', '40', '25:99', 'x')) == [('Location', lf1.LOCATION_MESSAGE)]
+
+
+@pytest.mark.parametrize('location', ['paris', 'brooklyn', '1000', '100011'])
+def test_unsupported_location(lf1, location):
+    assert lf1.validate_slots(slots(location)) == [('Location', lf1.LOCATION_MESSAGE)]
+
+
+def test_zip_code_must_be_covered(lf1, monkeypatch):
+    monkeypatch.setitem(lf1.zip_state, 'zip_codes', frozenset(['10013']))
+    assert violated(lf1, '10013') == []
+    assert lf1.validate_slots(slots('10001')) == [('Location', lf1.ZIP_COVERAGE_MESSAGE)]
+
+
+def test_manhattan_zip_codes_without_a_snapshot(lf1, monkeypatch):
+    monkeypatch.setattr(lf1, 'SNAPSHOT_PATH', '/nonexistent/restaurants.snapshot')
+    monkeypatch.setitem(lf1.zip_state, 'zip_codes', None)
+    assert violated(lf1, '10001') == []
+    assert violated(lf1, '11201') == ['Location']
+
+
+@pytest.mark.parametrize('cuisine, ok', [('indian', True), ('INDIAN', True), ('Japanese', True), ('thai', False)])
+def test_cuisine(lf1, cuisine, ok):
+    assert violated(lf1, cuisine=cuisine) == ([] if ok else ['Cuisine'])
+
+
+@pytest.mark.parametrize('num_people, ok', [
+    ('0', True), ('20', True), ('05', True), ('+3', True), (' 3', True),
+    ('21', False), ('-1', False), ('four', False), ('', False),
+])
+def test_party_size_is_parsed_like_the_original_validator(lf1, num_people, ok):
+    assert violated(lf1, num_people=num_people) == ([] if ok else ['NumberOfPeople'])
+
+
+@pytest.mark.parametrize('time, message', [
+    ('11:00', None), ('20:59', None), ('18:30', None),
+    ('10:59', 'CLOSED_TIME_MESSAGE'), ('21:00', 'CLOSED_TIME_MESSAGE'), ('23:00', 'CLOSED_TIME_MESSAGE'),
+    ('9:00', 'INVALID_TIME_MESSAGE'), ('1830', 'INVALID_TIME_MESSAGE'), ('12:60', 'INVALID_TIME_MESSAGE'),
+    ('25:00', 'INVALID_TIME_MESSAGE'), ('ab:cd', 'INVALID_TIME_MESSAGE'),
+])
+def test_dining_time(lf1, time, message):
+    expected = [] if message is None else [('DiningTime', getattr(lf1, message))]
+    assert lf1.validate_slots(slots(time=time)) == expected
+
+
+def test_invalid_email_is_reported(lf1):
+    assert violated(lf1, email='not-an-email') == ['email']
+
+
+def test_every_violation_is_reported_in_rule_order(lf1):
+    result = lf1.validate_dining_suggestion('brooklyn', 'thai', '40', '23:00', 'not-an-email')
+    assert not result['isValid']
+    assert result['violatedSlot'] == 'Location'
+    assert result['violatedSlots'] == ['Location', 'Cuisine', 'NumberOfPeople', 'DiningTime', 'email']
+    assert result['message']['content'].startswith(lf1.LOCATION_MESSAGE + ' ' + lf1.CUISINE_MESSAGE)